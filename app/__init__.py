@@ -5,9 +5,12 @@ from flask_cors import CORS
 from flask_socketio import SocketIO
 from flask_wtf.csrf import CSRFProtect
 from config import Config
+# Registers the state+sqlite:// and state+redis:// rate limit storage schemes
+from app.utils import limiter_storage
 import logging
 
-limiter = Limiter(get_remote_address, storage_uri="memory://")
+# Storage comes from RATELIMIT_STORAGE_URI so that all workers share counters
+limiter = Limiter(get_remote_address)
 socketio = SocketIO()
 csrf = CSRFProtect()
 
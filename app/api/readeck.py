@@ -1,9 +1,13 @@
-import requests
+import hashlib
 import logging
+from app.utils.upstream import fetch_limited_json, fetch_limited_text, UpstreamError
 
 logger = logging.getLogger(__name__)
 
-def fetch_articles(api_url, api_key, tag=None, sort="asc", cursor=None, socketio=None, emit_progress=False):
+ARTICLE_CONTENT_TYPES = ('text/html', 'application/xhtml+xml', 'text/plain')
+
+def fetch_articles(api_url, api_key, tag=None, sort="asc", cursor=None, socketio=None, emit_progress=False, *,
+                   max_json_bytes):
     if not api_url.endswith("/api"):
         api_url = api_url.rstrip("/") + "/api"
     
@@ -11,7 +15,8 @@ def fetch_articles(api_url, api_key, tag=None, sort="asc", cursor=None, socketio
 
     """
     Fetch all articles from Readeck with full content, optionally filtered by tag.
-    Uses pagination via offset/limit.
+    Uses pagination via offset/limit. Responses larger than max_json_bytes are
+    abandoned.
     """
     headers = {
         "Authorization": f"Bearer {api_key}",
@@ -37,9 +42,7 @@ def fetch_articles(api_url, api_key, tag=None, sort="asc", cursor=None, socketio
                 params["labels"] = tag
 
             logger.info(f"Fetching bookmarks: offset={offset}, limit={limit}")
-            response = requests.get(f"{api_url}/bookmarks", headers=headers, params=params)
-            response.raise_for_status()
-            bookmarks = response.json() 
+            bookmarks = fetch_limited_json(f"{api_url}/bookmarks", max_json_bytes, headers=headers, params=params)
             logger.info(f"Fetched {len(bookmarks)} bookmarks from Readeck")
 
             if not bookmarks:
@@ -48,9 +51,7 @@ def fetch_articles(api_url, api_key, tag=None, sort="asc", cursor=None, socketio
             for item in bookmarks:
                 article_id = item.get("id")
                 try:
-                    detail_resp = requests.get(f"{api_url}/bookmarks/{article_id}", headers=headers)
-                    detail_resp.raise_for_status()
-                    detail = detail_resp.json()
+                    detail = fetch_limited_json(f"{api_url}/bookmarks/{article_id}", max_json_bytes, headers=headers)
 
                     article = {
                         "id": detail.get("id"),
@@ -84,7 +85,28 @@ def fetch_articles(api_url, api_key, tag=None, sort="asc", cursor=None, socketio
 
     return all_articles, None, False
 
-def fetch_articles_by_ids(api_url, api_key, article_ids):
+def readeck_identity(api_url, api_key):
+    """Stable, non-reversible ID for a Readeck account: the instance URL plus API key."""
+    api_url = (api_url or "").rstrip("/")
+    if not api_url.endswith("/api"):
+        api_url += "/api"
+    return hashlib.sha256(f"{api_url}\0{api_key}".encode()).hexdigest()[:32]
+
+def article_cache_key(api_url, api_key, article_id):
+    # Keyed on the credentials as well, so one user can never be served another's article
+    return f"omnivore:articles:{readeck_identity(api_url, api_key)}:{article_id}"
+
+def fetch_articles_by_ids(api_url, api_key, article_ids, cache=None, cache_ttl=600, stats=None, *,
+                          max_json_bytes, max_article_bytes):
+    """
+    Fetch full articles by ID. With a state backend as cache, articles fetched
+    recently by any worker are reused instead of hitting Readeck again.
+
+    Articles whose metadata is larger than max_json_bytes, or whose HTML is
+    larger than max_article_bytes, are skipped. If stats
+    is a dict, the number of cached and fetched articles is counted into it and
+    skipped articles are listed under 'skipped' with the reason.
+    """
     if not api_url.endswith("/api"):
         api_url = api_url.rstrip("/") + "/api"
     logger.debug(f"Using Readeck API URL: {api_url}")
@@ -99,11 +121,22 @@ def fetch_articles_by_ids(api_url, api_key, article_ids):
             logger.warning("Skipping empty article ID")
             continue
 
+        cache_key = article_cache_key(api_url, api_key, article_id)
+        if cache is not None:
+            try:
+                cached = cache.get_json(cache_key)
+            except Exception as e:
+                logger.warning(f"Article cache unavailable: {str(e)}")
+                cached = None
+            if cached:
+                articles.append(cached)
+                if stats is not None:
+                    stats['cached'] = stats.get('cached', 0) + 1
+                continue
+
         try:
             # First fetch metadata
-            meta_resp = requests.get(f"{api_url}/bookmarks/{article_id}", headers=headers)
-            meta_resp.raise_for_status()
-            meta = meta_resp.json()
+            meta = fetch_limited_json(f"{api_url}/bookmarks/{article_id}", max_json_bytes, headers=headers)
 
             # Then fetch full article HTML
             article_url = meta.get("resources", {}).get("article", {}).get("src")
@@ -111,9 +144,8 @@ def fetch_articles_by_ids(api_url, api_key, article_ids):
                 logger.warning(f"No article content URL found for {article_id}")
                 continue
 
-            content_resp = requests.get(article_url, headers=headers)
-            content_resp.raise_for_status()
-            html_content = content_resp.text
+            html_content, _ = fetch_limited_text(article_url, max_article_bytes, ARTICLE_CONTENT_TYPES,
+                                                 headers=headers)
 
             article = {
                 "id": meta.get("id"),
@@ -125,7 +157,19 @@ def fetch_articles_by_ids(api_url, api_key, article_ids):
                 "tags": meta.get("labels", []),
             }
             articles.append(article)
+            if stats is not None:
+                stats['fetched'] = stats.get('fetched', 0) + 1
+
+            if cache is not None:
+                try:
+                    cache.set_json(cache_key, article, cache_ttl)
+                except Exception as e:
+                    logger.warning(f"Could not cache article {article_id}: {str(e)}")
 
+        except UpstreamError as e:
+            logger.warning(f"Skipping article {article_id}: {str(e)}")
+            if stats is not None:
+                stats.setdefault('skipped', []).append({'id': article_id, 'reason': type(e).__name__})
         except Exception as e:
             logger.error(f"Error fetching article {article_id}: {str(e)}")
 
@@ -1,15 +1,17 @@
-from flask import Blueprint, render_template, request, jsonify, send_file, url_for
-from app.api.readeck import fetch_articles, fetch_articles_by_ids
-from app.utils.pdf_generator import create_pdf, compress_pdf
-from flask_limiter import Limiter
-from flask_limiter.util import get_remote_address
+from flask import Blueprint, render_template, request, jsonify, send_file, url_for, current_app, make_response
+from app.api.readeck import fetch_articles, fetch_articles_by_ids, readeck_identity
+from app.utils.device_profiles import DEVICE_PROFILES, DEFAULT_PROFILE
+from app.utils.profiling import profiling_allowed, profiling_authorised, RequestProfiler, PROFILE_FILES
 import logging
 import os
+import re
 import tempfile
 from datetime import datetime
 import uuid
-from app import socketio
-from app.utils.epub_generator import create_epub
+from app import socketio, limiter
+from app.utils.state import get_state_backend
+from app.utils.jobs import JobRegistry
+from app.utils.admission import readeck_rate_limit_key, estimate_cost, get_scheduler, AdmissionTimeout
 from flask_wtf.csrf import CSRFError
 
 
@@ -19,9 +21,6 @@ bp = Blueprint('main', __name__)
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.WARNING) 
 
-# Set up rate limiting
-limiter = Limiter(get_remote_address, storage_uri="memory://")
-
 def log_pdf_articles(articles):
     log_dir = "logs"
     if not os.path.exists(log_dir):
@@ -52,10 +51,11 @@ def index():
 
 @bp.route('/settings')
 def settings():
-    return render_template('settings.html')
+    return render_template('settings.html', device_profiles=DEVICE_PROFILES, default_profile=DEFAULT_PROFILE)
 
 @bp.route('/fetch_articles', methods=['POST'])
-@limiter.limit("10 per minute") 
+@limiter.limit("10 per minute", key_func=readeck_rate_limit_key)
+@limiter.limit("60 per minute")
 def fetch_all_articles_route():
     api_key = request.json.get('api_key')
     readeck_url = request.json.get('readeck_url')
@@ -67,7 +67,8 @@ def fetch_all_articles_route():
     if not api_key:
         return jsonify({"error": "API key is required"}), 400
 
-    articles, _, _ = fetch_articles(readeck_url, api_key, tag=tag, sort=sort, socketio=socketio, emit_progress=emit_progress)
+    articles, _, _ = fetch_articles(readeck_url, api_key, tag=tag, sort=sort, socketio=socketio, emit_progress=emit_progress,
+                                    max_json_bytes=current_app.config['JSON_MAX_BYTES'])
     
     # Only limit to 10 for index page
     if page_type == 'index':
@@ -78,8 +79,56 @@ def fetch_all_articles_route():
     })
 
 @bp.route('/generate_document', methods=['POST'])
-@limiter.limit("10 per hour")
+# Per Readeck account, so users sharing an IP don't throttle each other; the
+# looser per-IP limit stops one client cycling through made-up API keys
+@limiter.limit("10 per hour", key_func=readeck_rate_limit_key)
+@limiter.limit("30 per hour")
 def generate_document():
+    data = request.get_json(silent=True) or {}
+    job_id = uuid.uuid4().hex
+
+    if profiling_allowed(current_app.config, request.headers, data):
+        # Stored under the job ID so the profile can be fetched alongside the job
+        with RequestProfiler(current_app.config['PROFILE_DIR'], job_id):
+            response = make_response(build_document(job_id))
+        response.headers['X-Profile-Id'] = job_id
+    else:
+        response = make_response(build_document(job_id))
+
+    # build_document only records a job once the request has been validated
+    jobs = JobRegistry(get_state_backend())
+    job = jobs.finish(job_id, status='done' if response.status_code < 400 else 'failed',
+                      http_status=response.status_code)
+    if job:
+        response.headers['X-Job-Id'] = job_id
+    return response
+
+@bp.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = JobRegistry(get_state_backend()).get(job_id)
+    if not job:
+        return jsonify({"error": "Unknown job"}), 404
+    return jsonify(job)
+
+@bp.route('/profiles/<profile_id>/<kind>')
+def download_profile(profile_id, kind):
+    if not profiling_authorised(current_app.config, request.headers):
+        return jsonify({"error": "Not found"}), 404
+    if kind not in PROFILE_FILES or not re.fullmatch(r'[0-9a-f]{32}', profile_id):
+        return jsonify({"error": "Unknown profile"}), 404
+
+    filename, mimetype = PROFILE_FILES[kind]
+    path = os.path.join(current_app.config['PROFILE_DIR'], profile_id, filename)
+    if not os.path.exists(path):
+        return jsonify({"error": "Unknown profile"}), 404
+    return send_file(path, as_attachment=True, download_name=f"{profile_id}_{filename}", mimetype=mimetype)
+
+def build_document(job_id):
+    # The document stack (WeasyPrint, PIL, ...) is imported on first use so that
+    # workers serving only pages start quickly; a preloading master imports it
+    # once up front instead (see app/utils/startup.py).
+    from app.utils.document_job import build_variants, OUTPUT_FORMATS
+
     try:
         socketio.emit('document_progress', {'progress': 5, 'status': 'Initializing document generation process'})
         
@@ -89,7 +138,8 @@ def generate_document():
         readeck_url = request.json.get('readeck_url')
         article_ids = data.get('article_ids', [])
         two_column_layout = request.json.get('two_column_layout', False)
-        output_format = request.json.get('output_format', 'pdf')
+        output_formats = data.get('output_formats') or [request.json.get('output_format', 'pdf')]
+        device_profiles = data.get('device_profiles') or [request.json.get('device_profile')]
 
         if not api_key:
             logger.warning("API key not provided")
@@ -101,8 +151,21 @@ def generate_document():
             socketio.emit('document_progress', {'progress': 100, 'status': 'Error: Too many articles selected'})
             return jsonify({"error": "You can only select up to 10 articles"}), 400
 
+        dither = request.json.get('dither', False)
+        variants = build_variants(output_formats, device_profiles, two_column_layout, dither)
+        if not variants:
+            socketio.emit('document_progress', {'progress': 100, 'status': 'Error: Unsupported output format'})
+            return jsonify({"error": f"Supported output formats: {', '.join(OUTPUT_FORMATS)}"}), 400
+
+        JobRegistry(get_state_backend()).start(job_id, article_count=len(article_ids),
+                                               output_formats=[v['format'] for v in variants])
+
         socketio.emit('document_progress', {'progress': 10, 'status': 'Fetching articles'})
-        articles = fetch_articles_by_ids(readeck_url, api_key, article_ids)
+        fetch_stats = {}
+        articles = fetch_articles_by_ids(readeck_url, api_key, article_ids, cache=get_state_backend(),
+                                         cache_ttl=current_app.config['ARTICLE_CACHE_TTL'], stats=fetch_stats,
+                                         max_json_bytes=current_app.config['JSON_MAX_BYTES'],
+                                         max_article_bytes=current_app.config['ARTICLE_MAX_BYTES'])
 
         if not articles:
             logger.warning("No articles fetched. Check your API key or criteria.")
@@ -110,50 +173,75 @@ def generate_document():
             return jsonify({"error": "No articles fetched. Check your API key or criteria."}), 404
 
         socketio.emit('document_progress', {'progress': 20, 'status': 'Articles fetched successfully'})
-        
+
+        job_cost = estimate_cost(articles, variants, fetch_stats.get('cached', 0))
+        JobRegistry(get_state_backend()).update(job_id, status='queued', **job_cost,
+                                                skipped_articles=fetch_stats.get('skipped', []))
+
+        def report_queue_position(position):
+            status = f'Queued: {position} job(s) ahead' if position else 'Queued: waiting for a free slot'
+            socketio.emit('document_progress', {'progress': 25, 'status': status})
+
+        scheduler = get_scheduler(sleep=socketio.sleep)
+        try:
+            queued_seconds = scheduler.acquire(job_id, readeck_identity(readeck_url, api_key), job_cost['cost'],
+                                               on_wait=report_queue_position)
+        except AdmissionTimeout as e:
+            logger.warning(f"Job {job_id} not admitted: {e}")
+            socketio.emit('document_progress', {'progress': 100, 'status': 'Error: Server busy, please try again shortly'})
+            response = jsonify({"error": "Server busy, please try again shortly"})
+            response.headers['Retry-After'] = str(e.retry_after)
+            return response, 503
+        JobRegistry(get_state_backend()).update(job_id, status='running', queued_seconds=round(queued_seconds, 2))
+
+        try:
+            return render_job(job_id, articles, variants)
+        finally:
+            scheduler.release(job_id)
+
+    except Exception as e:
+        logger.exception(f"Unexpected error: {e}")
+        socketio.emit('document_progress', {'progress': 100, 'status': f'Error: {str(e)}'})
+        return jsonify({"error": str(e)}), 500
+
+def render_job(job_id, articles, variants):
+    from app.utils.document_job import render_variants, variant_filename, zip_documents, MIME_TYPES
+
+    try:
         log_pdf_articles(articles)
         current_date = datetime.now().strftime("%Y%m%d")
-        unique_id = uuid.uuid4().hex[:8]
-        
-        if output_format == 'epub':
-            document_filename = f"Readeck_{current_date}_{unique_id}.epub"
-        else:
-            document_filename = f"Readeck_{current_date}_{unique_id}.pdf"
+        unique_id = job_id[:8]
+        base_filename = f"Readeck_{current_date}_{unique_id}"
+        label = '+'.join(dict.fromkeys(v['format'].upper() for v in variants))
 
-        socketio.emit('document_progress', {'progress': 30, 'status': f'Starting {output_format.upper()} creation'})
+        socketio.emit('document_progress', {'progress': 30, 'status': f'Starting {label} creation'})
 
         with tempfile.TemporaryDirectory() as temp_dir:
-            temp_document_path = os.path.join(temp_dir, f'temp_omnivore_articles.{output_format}')
-            
-            if output_format == 'epub':
-                document_path = create_epub(articles, current_date, temp_document_path)
-            else:
-                document_path = create_pdf(articles, current_date, temp_document_path, two_column_layout)
-            
-            if document_path and os.path.exists(document_path):
-                socketio.emit('document_progress', {'progress': 80, 'status': f'{output_format.upper()} created'})
-
-                if output_format == 'pdf':
-                    compressed_pdf_path = os.path.join(temp_dir, document_filename)
-                    final_document_path = compress_pdf(document_path, compressed_pdf_path)
-                else:
-                    final_document_path = document_path
-
-                if os.path.exists(final_document_path):
-                    logger.info(f"Sending file: {final_document_path}")
-                    socketio.emit('document_progress', {'progress': 90, 'status': f'{output_format.upper()} prepared, ready to send'})
-                    
-                    socketio.emit('document_progress', {'progress': 100, 'status': f'{output_format.upper()} ready for download'})
-                    return send_file(final_document_path, as_attachment=True, download_name=document_filename, 
-                                     mimetype='application/epub+zip' if output_format == 'epub' else 'application/pdf')
-                else:
-                    logger.error(f"Final document not found at: {final_document_path}")
-                    socketio.emit('document_progress', {'progress': 100, 'status': f'Error: Final {output_format.upper()} not found'})
-                    return jsonify({"error": f"Final {output_format.upper()} not found"}), 500
+            sizes = {}
+            results = render_variants(articles, current_date, temp_dir, variants, report=sizes)
+            JobRegistry(get_state_backend()).update(job_id, sizes=sizes)
+            documents = [(variant_filename(base_filename, variant, variants), path)
+                         for variant, path in results if path and os.path.exists(path)]
+
+            if len(documents) != len(variants):
+                logger.error(f"Only {len(documents)} of {len(variants)} documents were created")
+                socketio.emit('document_progress', {'progress': 100, 'status': f'Error: Failed to create {label}'})
+                return jsonify({"error": f"Failed to create {label}"}), 500
+
+            socketio.emit('document_progress', {'progress': 90, 'status': f'{label} prepared, ready to send'})
+
+            if len(documents) == 1:
+                document_filename, final_document_path = documents[0]
+                output_format = variants[0]['format']
             else:
-                logger.error(f"Original document not found at: {document_path}")
-                socketio.emit('document_progress', {'progress': 100, 'status': f'Error: Failed to create {output_format.upper()}'})
-                return jsonify({"error": f"Failed to create {output_format.upper()}"}), 500
+                document_filename = f"{base_filename}.zip"
+                final_document_path = zip_documents(os.path.join(temp_dir, document_filename), documents)
+                output_format = 'zip'
+
+            logger.info(f"Sending file: {final_document_path}")
+            socketio.emit('document_progress', {'progress': 100, 'status': f'{label} ready for download'})
+            return send_file(final_document_path, as_attachment=True, download_name=document_filename,
+                             mimetype=MIME_TYPES[output_format])
 
     except Exception as e:
         logger.exception(f"Unexpected error: {e}")
@@ -142,6 +142,7 @@ function fetchArticlesAndGenerateDocument() {
     const apiKey = Cookies.get('readeckApiKey');
     const readeckUrl = Cookies.get('readeckUrl');
     const twoColumnLayout = Cookies.get('readeckTwoColumnLayout') === 'true';
+    const deviceProfile = Cookies.get('readeckDeviceProfile');
     const tag = document.getElementById('tag').value;
 
     let sortInput = document.getElementById('sort').value;
@@ -184,6 +185,7 @@ function fetchArticlesAndGenerateDocument() {
                 readeck_url: readeckUrl,
                 article_ids: data.articles.map(article => article.id),
                 two_column_layout: twoColumnLayout,
+                device_profile: deviceProfile,
                 output_format: outputFormat
             }),
         });
@@ -216,6 +218,7 @@ function generateDocument() {
     const apiKey = Cookies.get('readeckApiKey');
     const readeckUrl = Cookies.get('readeckUrl');
     const twoColumnLayout = Cookies.get('readeckTwoColumnLayout') === 'true';
+    const deviceProfile = Cookies.get('readeckDeviceProfile');
 
     if (!apiKey || !readeckUrl) {
         alert('Please set your API key and Readeck URL in the settings.');
@@ -241,6 +244,7 @@ function generateDocument() {
             article_ids: selectedArticles,
             outputFormat: 'pdf',
             two_column_layout: twoColumnLayout,
+            device_profile: deviceProfile,
             emit_progress: true,
         }),
     })
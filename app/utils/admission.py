@@ -0,0 +1,226 @@
+import logging
+import re
+import time
+import uuid
+from contextlib import contextmanager
+from flask import request, current_app
+from flask_limiter.util import get_remote_address
+from app.api.readeck import readeck_identity
+from app.utils.state import KEY_PREFIX, StateBackendError, get_state_backend
+
+logger = logging.getLogger(__name__)
+
+ADMISSION_PREFIX = f'{KEY_PREFIX}admission:'
+QUEUE_KEY = f'{ADMISSION_PREFIX}queue'
+LOCK_KEY = f'{ADMISSION_PREFIX}lock'
+
+IMG_TAG_RE = re.compile(r'<img\b', re.IGNORECASE)
+
+# Relative cost of the work a job does, in units of roughly "one short article
+# rendered to PDF". Image fetching and optimisation happen once per job; the
+# rest is paid again for each output variant.
+COST_PER_IMAGE = 0.5
+COST_PER_ARTICLE = 1.0
+COST_PER_HTML_KB = 0.02
+FORMAT_COST = {'pdf': 1.0, 'epub': 0.3, 'cbz': 2.0}
+
+# How long past the admission timeout a waiter may go without polling before
+# its entry is dropped; a slow lock or a long GC pause must not lose it
+STALE_MARGIN = 30
+
+def readeck_rate_limit_key():
+    """Rate limit key for the current request: the Readeck account if given, else the client IP."""
+    data = request.get_json(silent=True) or {}
+    if data.get('api_key') and data.get('readeck_url'):
+        return f"readeck:{readeck_identity(data['readeck_url'], data['api_key'])}"
+    return get_remote_address()
+
+def estimate_cost(articles, variants, cached_articles=0):
+    """Estimate a job's cost from what the fetch stage returned."""
+    html_bytes = sum(len((article.get('content') or '').encode('utf-8')) for article in articles)
+    images = sum(len(IMG_TAG_RE.findall(article.get('content') or '')) for article in articles)
+    per_variant = len(articles) * COST_PER_ARTICLE + html_bytes / 1024 * COST_PER_HTML_KB
+    variant_factor = sum(FORMAT_COST.get(variant['format'], 1.0) for variant in variants)
+    return {
+        'cost': round(images * COST_PER_IMAGE + per_variant * variant_factor, 2),
+        'articles': len(articles),
+        'cached_articles': cached_articles,
+        'html_bytes': html_bytes,
+        'images': images,
+    }
+
+class AdmissionTimeout(Exception):
+    def __init__(self, position, retry_after):
+        super().__init__(f"Server busy: {position} jobs ahead")
+        self.position = position
+        self.retry_after = retry_after
+
+class FairScheduler:
+    """
+    Admission control for document generation, shared by every worker through
+    the state backend.
+
+    At most `slots` jobs render at once. Waiting jobs are served in weighted
+    fair queuing order across Readeck users: each job gets a virtual finish tag
+    of max(virtual time, the user's previous finish tag) + cost / weight, and
+    the lowest tag goes next. A user who submits heavy jobs, or many jobs, falls
+    behind users who submit light ones, and small jobs overtake large ones.
+    Jobs costing at most `small_job_cost` may also use `express_slots` extra
+    slots, so short interactive bundles are not stuck behind big ones.
+
+    The queue is one JSON document guarded by a short-lived lock key. Waiters
+    refresh their entry while polling, and running jobs hold a lease, so a
+    crashed worker cannot wedge the queue. A waiter is only dropped once it has
+    not polled for longer than any live request could wait, and a live waiter
+    that finds its entry gone anyway is queued again.
+    """
+
+    def __init__(self, backend, slots, express_slots=1, small_job_cost=5, max_jobs_per_user=1,
+                 lease=180, poll_interval=0.25, admission_timeout=60, sleep=time.sleep):
+        self.backend = backend
+        self.slots = slots
+        self.express_slots = express_slots
+        self.small_job_cost = small_job_cost
+        self.max_jobs_per_user = max_jobs_per_user
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.sleep = sleep
+        self.admission_timeout = admission_timeout
+        self.stale_after = admission_timeout + STALE_MARGIN
+
+    @contextmanager
+    def _locked(self):
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + 10
+        while not self.backend.add(LOCK_KEY, token, ttl=5):
+            if time.monotonic() > deadline:
+                raise StateBackendError("Timed out waiting for the admission queue lock")
+            self.sleep(0.01)
+        try:
+            queue = self.backend.get_json(QUEUE_KEY) or {}
+            queue.setdefault('virtual_time', 0.0)
+            queue.setdefault('finish_tags', {})
+            queue.setdefault('waiting', {})
+            queue.setdefault('running', {})
+            self._prune(queue, time.time())
+            yield queue
+            self.backend.set_json(QUEUE_KEY, queue)
+        finally:
+            if self.backend.get(LOCK_KEY) == token.encode():
+                self.backend.delete(LOCK_KEY)
+
+    def _prune(self, queue, now):
+        for ticket, job in list(queue['running'].items()):
+            if job['expires'] <= now:
+                logger.warning(f"Admission lease for job {ticket} expired")
+                del queue['running'][ticket]
+        for ticket, job in list(queue['waiting'].items()):
+            if now - job['seen'] > self.stale_after:
+                del queue['waiting'][ticket]
+        if not queue['waiting'] and not queue['running'] and queue['finish_tags']:
+            # Idle: nobody is owed anything, so past usage is forgiven
+            queue['virtual_time'] = max(queue['virtual_time'], *queue['finish_tags'].values())
+        # A user's finish tag stops mattering once virtual time has passed it
+        queue['finish_tags'] = {user: tag for user, tag in queue['finish_tags'].items()
+                                if tag > queue['virtual_time']}
+
+    def _is_small(self, job):
+        return job['cost'] <= self.small_job_cost
+
+    def _next_ticket(self, queue):
+        running = list(queue['running'].values())
+        running_by_user = {}
+        for job in running:
+            running_by_user[job['user']] = running_by_user.get(job['user'], 0) + 1
+        general_free = len(running) < self.slots
+        express_free = len(running) < self.slots + self.express_slots
+
+        eligible = [
+            (job['finish'], job['enqueued'], ticket) for ticket, job in queue['waiting'].items()
+            if running_by_user.get(job['user'], 0) < self.max_jobs_per_user
+            and (general_free or (express_free and self._is_small(job)))
+        ]
+        return min(eligible)[2] if eligible else None
+
+    def _position(self, queue, ticket):
+        finish = queue['waiting'][ticket]['finish']
+        return sum(1 for job in queue['waiting'].values() if job['finish'] < finish)
+
+    def _add_waiting(self, queue, ticket, user, cost, weight, now):
+        start = max(queue['virtual_time'], queue['finish_tags'].get(user, 0.0))
+        finish = start + max(cost, 0.1) / weight
+        queue['finish_tags'][user] = finish
+        queue['waiting'][ticket] = {'user': user, 'cost': cost, 'start': start, 'finish': finish,
+                                    'enqueued': now, 'seen': now}
+        return queue['waiting'][ticket]
+
+    def enqueue(self, ticket, user, cost, weight=1.0):
+        with self._locked() as queue:
+            self._add_waiting(queue, ticket, user, cost, weight, time.time())
+
+    def try_admit(self, ticket, user, cost, weight=1.0):
+        """
+        Admit ticket if it is next; return (admitted, number of jobs ahead of it).
+        A ticket whose entry has been pruned or lost is queued again.
+        """
+        now = time.time()
+        with self._locked() as queue:
+            job = queue['waiting'].get(ticket)
+            if job is None:
+                logger.warning(f"Job {ticket} was missing from the admission queue; queueing it again")
+                job = self._add_waiting(queue, ticket, user, cost, weight, now)
+            job['seen'] = now
+            if self._next_ticket(queue) != ticket:
+                return False, self._position(queue, ticket)
+            del queue['waiting'][ticket]
+            queue['virtual_time'] = max(queue['virtual_time'], job['start'])
+            queue['running'][ticket] = {'user': job['user'], 'cost': job['cost'],
+                                        'started': now, 'expires': now + self.lease}
+            return True, 0
+
+    def release(self, ticket):
+        with self._locked() as queue:
+            queue['running'].pop(ticket, None)
+            job = queue['waiting'].pop(ticket, None)
+            # A job that never ran gives back its place in the user's share
+            if job and queue['finish_tags'].get(job['user']) == job['finish']:
+                queue['finish_tags'][job['user']] = job['start']
+
+    def acquire(self, ticket, user, cost, weight=1.0, on_wait=None):
+        """
+        Block until ticket may run and return the seconds spent queued. Raises
+        AdmissionTimeout after admission_timeout seconds; on_wait(position) is
+        called whenever the number of jobs ahead changes.
+        """
+        timeout = self.admission_timeout
+        started = time.monotonic()
+        self.enqueue(ticket, user, cost, weight)
+        last_position = None
+        try:
+            while True:
+                admitted, position = self.try_admit(ticket, user, cost, weight)
+                if admitted:
+                    return time.monotonic() - started
+                if position != last_position and on_wait:
+                    on_wait(position)
+                last_position = position
+                if time.monotonic() - started > timeout:
+                    raise AdmissionTimeout(position, retry_after=max(5, int(timeout / 2)))
+                self.sleep(self.poll_interval)
+        except Exception:
+            self.release(ticket)
+            raise
+
+
+def get_scheduler(sleep=time.sleep):
+    config = current_app.config
+    return FairScheduler(
+        get_state_backend(),
+        slots=config['GENERATION_SLOTS'],
+        express_slots=config['GENERATION_EXPRESS_SLOTS'],
+        small_job_cost=config['SMALL_JOB_COST'],
+        max_jobs_per_user=config['MAX_JOBS_PER_USER'],
+        admission_timeout=config['ADMISSION_TIMEOUT'],
+        lease=config['GENERATION_LEASE'],
+        sleep=sleep,
+    )
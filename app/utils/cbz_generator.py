@@ -0,0 +1,129 @@
+import io
+import logging
+import os
+import subprocess
+import tempfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from PIL import Image
+from app.utils.profiling import timed_subprocess, profiled_thread_initializer
+
+logger = logging.getLogger(__name__)
+
+# E-ink panels show 16 grey levels; dithering to exactly those avoids banding
+EINK_GREY_LEVELS = 16
+
+# Ghostscript processes per CBZ. Several jobs can rasterise at once, so this
+# stays small rather than following the CPU count.
+DEFAULT_RASTER_WORKERS = 2
+
+# Pages per Ghostscript run. Short ranges are handed out in page order, so the
+# workers move through the book together and only a few finished pages ever
+# wait for an earlier one before they can be written.
+RASTER_CHUNK_PAGES = 8
+
+def count_pdf_pages(pdf_path):
+    # The PDF is built from untrusted web content, so gs stays in SAFER mode
+    # with read access to this one file only
+    try:
+        result = timed_subprocess('gs', subprocess.run, [
+            'gs', '-q', '-dNODISPLAY', '-dSAFER', f'--permit-file-read={pdf_path}',
+            '-c', f'({pdf_path}) (r) file runpdfbegin pdfpagecount = quit'
+        ], check=True, capture_output=True, text=True)
+        return int(result.stdout.strip().splitlines()[-1])
+    except (subprocess.CalledProcessError, ValueError, IndexError) as e:
+        logger.warning(f"Could not count pages in {pdf_path}: {e}")
+        return None
+
+def rasterise_pages(pdf_path, output_dir, dpi, first_page=None, last_page=None):
+    """Rasterise a page range to grayscale PNGs, returning their paths in page order."""
+    prefix = f"pages_{first_page or 1}"
+    command = [
+        'gs', '-dSAFER', '-sDEVICE=pnggray', f'-r{dpi}',
+        '-dTextAlphaBits=4', '-dGraphicsAlphaBits=4',
+        '-dNOPAUSE', '-dQUIET', '-dBATCH',
+        f'-sOutputFile={os.path.join(output_dir, prefix)}_%05d.png',
+    ]
+    if first_page:
+        command += [f'-dFirstPage={first_page}', f'-dLastPage={last_page}']
+    timed_subprocess('gs', subprocess.run, command + [pdf_path], check=True)
+
+    return sorted(
+        os.path.join(output_dir, name) for name in os.listdir(output_dir)
+        if name.startswith(f"{prefix}_") and name.endswith('.png')
+    )
+
+def page_ranges(page_count, chunk=RASTER_CHUNK_PAGES):
+    return [(start, min(start + chunk - 1, page_count)) for start in range(1, page_count + 1, chunk)]
+
+def eink_palette():
+    palette = []
+    for level in range(EINK_GREY_LEVELS):
+        grey = round(level * 255 / (EINK_GREY_LEVELS - 1))
+        palette.extend((grey, grey, grey))
+    palette_image = Image.new('P', (1, 1))
+    palette_image.putpalette(palette + [0] * (768 - len(palette)))
+    return palette_image
+
+def finish_page(page_path, dither):
+    """Return the final PNG bytes for a rasterised page, dithered to e-ink grey levels if asked."""
+    try:
+        if not dither:
+            with open(page_path, 'rb') as page_file:
+                return page_file.read()
+
+        with Image.open(page_path) as page:
+            quantised = page.convert('RGB').quantize(palette=eink_palette(), dither=Image.Dither.FLOYDSTEINBERG)
+        page_bytes = io.BytesIO()
+        quantised.convert('L').save(page_bytes, format='PNG', optimize=True)
+        return page_bytes.getvalue()
+    finally:
+        os.remove(page_path)
+
+def create_cbz(pdf_path, cbz_path, profile, dither=False, workers=DEFAULT_RASTER_WORKERS):
+    """
+    Rasterise a rendered PDF into device-resolution grayscale pages packed as a CBZ.
+
+    pdf_path should be the uncompressed WeasyPrint output, so images are
+    rasterised from full-resolution data. Short page ranges are rasterised by up
+    to `workers` Ghostscript processes in parallel; rasterised pages wait on
+    disk. Some readers follow archive order rather than names, so pages are
+    written strictly in order: a finished page is held only until the pages
+    before it are in the archive, then written and dropped.
+    """
+    workers = max(1, workers or 1)
+    page_count = count_pdf_pages(pdf_path)
+    ranges = page_ranges(page_count) if page_count else [(None, None)]
+    finished = {}
+    next_page = 1
+    pages_written = 0
+
+    with tempfile.TemporaryDirectory() as raster_dir:
+        with zipfile.ZipFile(cbz_path, 'w', compression=zipfile.ZIP_STORED) as archive, \
+                ThreadPoolExecutor(max_workers=workers, initializer=profiled_thread_initializer()) as executor:
+            # gs numbers pages per process, so keep track of where each range starts
+            pending = {
+                executor.submit(rasterise_pages, pdf_path, raster_dir, profile['dpi'], first, last): ('range', first or 1)
+                for first, last in ranges
+            }
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    kind, number = pending.pop(future)
+                    if kind == 'range':
+                        for offset, page_path in enumerate(future.result()):
+                            pending[executor.submit(finish_page, page_path, dither)] = ('page', number + offset)
+                    else:
+                        finished[number] = future.result()
+                        while next_page in finished:
+                            archive.writestr(f"page_{next_page:05d}.png", finished.pop(next_page))
+                            next_page += 1
+                            pages_written += 1
+
+            # Only left over if gs produced fewer pages than counted for a range
+            for number in sorted(finished):
+                archive.writestr(f"page_{number:05d}.png", finished.pop(number))
+                pages_written += 1
+
+    logger.info(f"CBZ created with {pages_written} pages: {cbz_path}")
+    return cbz_path
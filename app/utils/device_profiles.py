@@ -0,0 +1,92 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PROFILE = 'large'
+
+# Page sizes are CSS pixels used for layout. `dpi` is the resolution the page
+# maps to on the device, so page_width / 96 * dpi is the panel width in pixels.
+# `font_scale` multiplies every font size; `font_sizes` optionally pins the size
+# of individual elements (body, h1, h2, metadata, caption, toc-h1, toc-list).
+DEVICE_PROFILES = {
+    'large': {
+        'label': 'Large e-reader (10"+, e.g. reMarkable, Boox Note)',
+        'page_width': 810,
+        'page_height': 1080,
+        'dpi': 166,
+        'font_scale': 1.0,
+        'margin_vertical': 50,
+        'margin_horizontal': 50,
+        'image_max_width': 800,
+        'image_max_height': 1000,
+        'columns': 1,
+    },
+    'large-two-column': {
+        'label': 'Large e-reader, two columns',
+        'page_width': 810,
+        'page_height': 1080,
+        'dpi': 166,
+        'font_scale': 1.0,
+        # Sizes the legacy two_column_layout flag has always used; other text is unscaled
+        'font_sizes': {'body': 13.5, 'h1': 24},
+        'margin_vertical': 50,
+        'margin_horizontal': 25,
+        'image_max_width': 800,
+        'image_max_height': 1000,
+        'columns': 2,
+    },
+    'kindle-scribe': {
+        'label': 'Kindle Scribe',
+        'page_width': 810,
+        'page_height': 1080,
+        'dpi': 220,
+        'font_scale': 1.0,
+        'margin_vertical': 50,
+        'margin_horizontal': 50,
+        'image_max_width': 800,
+        'image_max_height': 1000,
+        'columns': 1,
+    },
+    'medium': {
+        'label': 'Medium e-reader (7"-8", e.g. Kobo Libra, Kindle Oasis)',
+        'page_width': 630,
+        'page_height': 840,
+        'dpi': 192,
+        'font_scale': 1.1,
+        'margin_vertical': 40,
+        'margin_horizontal': 35,
+        'image_max_width': 600,
+        'image_max_height': 780,
+        'columns': 1,
+    },
+    'small': {
+        'label': 'Small e-reader (6"-7", e.g. Kindle Paperwhite, Kobo Clara)',
+        'page_width': 540,
+        'page_height': 720,
+        'dpi': 220,
+        'font_scale': 1.2,
+        'margin_vertical': 30,
+        'margin_horizontal': 25,
+        'image_max_width': 520,
+        'image_max_height': 680,
+        'columns': 1,
+    },
+}
+
+def get_profile(name=None, two_column_layout=False):
+    """Return the named profile, honouring the legacy two-column flag for the default."""
+    name = name or DEFAULT_PROFILE
+    if name not in DEVICE_PROFILES:
+        logger.warning(f"Unknown device profile '{name}', using '{DEFAULT_PROFILE}'")
+        name = DEFAULT_PROFILE
+    if two_column_layout and name == DEFAULT_PROFILE:
+        name = 'large-two-column'
+    return dict(DEVICE_PROFILES[name], name=name)
+
+def image_target_width(profile):
+    """Width an image actually renders at: page minus margins, split across columns."""
+    content_width = profile['page_width'] - 2 * profile['margin_horizontal']
+    if profile['columns'] > 1:
+        gap = 20 * (profile['columns'] - 1)
+        return (content_width - gap) // profile['columns']
+    return content_width
@@ -0,0 +1,142 @@
+import logging
+import os
+import zipfile
+from flask import current_app
+from app import socketio
+from app.utils.device_profiles import get_profile, image_target_width
+from app.utils.image_cache import ImageCache
+from app.utils.pdf_generator import create_pdf, compress_pdf, process_articles
+from app.utils.epub_generator import create_epub
+from app.utils.cbz_generator import create_cbz
+
+logger = logging.getLogger(__name__)
+
+OUTPUT_FORMATS = ('pdf', 'epub', 'cbz')
+
+# Formats laid out per device profile; an EPUB reflows on the device instead
+PAGED_FORMATS = ('pdf', 'cbz')
+
+MIME_TYPES = {
+    'pdf': 'application/pdf',
+    'epub': 'application/epub+zip',
+    'cbz': 'application/vnd.comicbook+zip',
+    'zip': 'application/zip',
+}
+
+def build_variants(output_formats, profile_names, two_column_layout=False, dither=False):
+    """
+    Expand requested formats and device profiles into a list of variants to render.
+
+    PDFs and CBZs are rendered once per profile; an EPUB reflows on the device,
+    so one copy is enough whatever profiles were asked for.
+    """
+    variants = []
+    for output_format in dict.fromkeys(output_formats):
+        if output_format in PAGED_FORMATS:
+            profiles = {}
+            for name in profile_names or [None]:
+                profile = get_profile(name, two_column_layout)
+                profiles.setdefault(profile['name'], profile)
+            variants.extend({'format': output_format, 'profile': profile, 'dither': dither}
+                            for profile in profiles.values())
+        elif output_format == 'epub':
+            variants.append({'format': 'epub', 'profile': None})
+        else:
+            logger.warning(f"Ignoring unsupported output format: {output_format}")
+    return variants
+
+def variant_filename(base_name, variant, variants):
+    format_count = sum(1 for v in variants if v['format'] == variant['format'])
+    if variant['profile'] and format_count > 1:
+        return f"{base_name}_{variant['profile']['name']}.{variant['format']}"
+    return f"{base_name}.{variant['format']}"
+
+def render_variant(articles, current_date, output_dir, variant, image_cache, processed_articles,
+                   release_images=False):
+    output_format = variant['format']
+    name = variant['profile']['name'] if variant['profile'] else output_format
+    temp_path = os.path.join(output_dir, f'temp_{output_format}_{name}.{output_format}')
+
+    if output_format == 'epub':
+        return create_epub(articles, current_date, temp_path, image_cache=image_cache,
+                           processed_articles=processed_articles, release_images=release_images)
+
+    pdf_path = os.path.join(output_dir, f'temp_{output_format}_{name}.pdf')
+    # Compressed once here rather than also inside create_pdf; a CBZ is rasterised
+    # from the raw output, since /ebook compression downsamples images to 150 dpi
+    document_path = create_pdf(articles, current_date, pdf_path, profile=variant['profile'],
+                               image_cache=image_cache, processed_articles=processed_articles, compress=False)
+    if not document_path or not os.path.exists(document_path):
+        return None
+    if output_format == 'cbz':
+        return create_cbz(document_path, temp_path, variant['profile'], dither=variant['dither'],
+                          workers=current_app.config['CBZ_RASTER_WORKERS'])
+    return compress_pdf(document_path, os.path.join(output_dir, f'{name}_final.pdf'))
+
+def article_sizes(articles, processed_articles, image_cache):
+    """Per-article size accounting: source HTML plus the images embedded for it."""
+    processed_by_id = {processed['id']: processed for processed in processed_articles}
+    sizes = []
+    for article in articles:
+        content = article.get('content') or ''
+        processed = processed_by_id.get(article.get('id'))
+        images, image_bytes = image_cache.embedded(processed['processed_content']) if processed else (0, 0)
+        sizes.append({
+            'id': article.get('id'),
+            'title': article.get('title'),
+            'html_bytes': len(content.encode('utf-8')),
+            'images': images,
+            'image_bytes': image_bytes,
+            'processed': processed is not None,
+        })
+    return sizes
+
+def render_variants(articles, current_date, output_dir, variants, report=None):
+    """
+    Render every variant of a bundle from a single processing pass.
+
+    Articles are processed and images fetched once, at the size needed by the
+    largest profile, then the variants are rendered one after another. WeasyPrint
+    layout is pure Python and holds the GIL (and under the eventlet worker threads
+    are green), so rendering them in threads would gain nothing. Returns a list
+    of (variant, path) with path None for variants that failed. If report is a
+    dict, per-article sizes and image totals are stored in it.
+    """
+    profiles = [v['profile'] for v in variants if v['profile']]
+    if profiles:
+        image_cache = ImageCache.from_config(current_app.config, max(p['image_max_width'] for p in profiles),
+                                             max(p['image_max_height'] for p in profiles))
+        target_width = max(image_target_width(p) for p in profiles)
+    else:
+        image_cache = ImageCache.from_config(current_app.config)
+        target_width = None
+
+    socketio.emit('document_progress', {'progress': 35, 'status': 'Processing articles and images'})
+    processed_articles = process_articles(articles, image_cache, target_width)
+    image_report = image_cache.log_report()
+    if report is not None:
+        report['articles'] = article_sizes(articles, processed_articles, image_cache)
+        report['images'] = image_report
+
+    socketio.emit('document_progress', {'progress': 50, 'status': f'Rendering {len(variants)} document(s)'})
+    # An EPUB is rendered last, so it can free each image's data once it is in
+    # the archive without taking it away from a PDF still to be rendered
+    paths = {}
+    ordered = sorted(range(len(variants)), key=lambda index: variants[index]['format'] == 'epub')
+    for position, index in enumerate(ordered):
+        variant = variants[index]
+        last = position == len(ordered) - 1
+        try:
+            paths[index] = render_variant(articles, current_date, output_dir, variant, image_cache,
+                                          processed_articles, release_images=last)
+        except Exception as e:
+            logger.exception(f"Error rendering {variant['format']} variant: {e}")
+            paths[index] = None
+    return [(variant, paths[index]) for index, variant in enumerate(variants)]
+
+def zip_documents(zip_path, documents):
+    """Bundle (arcname, path) pairs into one download; documents are already compressed."""
+    with zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_STORED) as archive:
+        for arcname, path in documents:
+            archive.write(path, arcname)
+    return zip_path
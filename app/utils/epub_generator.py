@@ -1,94 +1,256 @@
 import os
-from ebooklib import epub
+import re
+import logging
+import zipfile
+from functools import lru_cache
+from html import escape
 from bs4 import BeautifulSoup
 from app.utils.pdf_generator import process_content, fetch_url_wrapper
+from app.utils.image_cache import ImageCache
+from app.utils.profiling import profiled_thread_initializer
 from flask import current_app
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import uuid
-from datetime import datetime
+from datetime import datetime, timezone
 from PIL import Image
 import io
 
-def create_epub(articles, current_date, epub_path):
-    book = epub.EpubBook()
-
-    # Set metadata
-    book.set_identifier(str(uuid.uuid4()))
-    book.set_title(f'Omnivore Articles {current_date}')
-    book.set_language('en')
-    book.add_author('Various')
-
-    # Add cover image
-    cover_svg_path = os.path.join(current_app.root_path, 'static', 'images', 'cover.svg')
-    if os.path.exists(cover_svg_path):
-        # Convert SVG to PNG
-        from cairosvg import svg2png
-        png_data = svg2png(url=cover_svg_path)
-        cover_image = Image.open(io.BytesIO(png_data))
-        
-        # Resize image if necessary
-        cover_image.thumbnail((1000, 1000))  # Adjust size as needed
-        
-        # Save as JPEG
-        buffer = io.BytesIO()
-        cover_image.save(buffer, 'JPEG')
-        buffer.seek(0)
-        
-        # Add cover to EPUB
-        book.set_cover("cover.jpg", buffer.getvalue())
-
-    # Create chapters
-    chapters = []
-    toc = []
-    spine = ['nav']
-
-    # Reset epub_images
-    process_content.epub_images = []
-
-    for index, article in enumerate(articles, start=1):
-        chapter = epub.EpubHtml(title=article['title'], file_name=f'chapter_{index}.xhtml', lang='en')
-        
-        # Process content
-        processed_content = process_content(article['content'], for_epub=True)
-        
-        # Create chapter content
-        chapter_content = f'''
-        <html>
-        <head>
-            <title>{article['title']}</title>
-        </head>
-        <body>
-            <h1>{article['title']}</h1>
-            <p><em>By {article['author'] or 'Unknown'}</em></p>
-            {processed_content}
-        </body>
-        </html>
-        '''
-        
-        chapter.set_content(chapter_content)
-        book.add_item(chapter)
-        chapters.append(chapter)
-        toc.append(epub.Link(f'chapter_{index}.xhtml', article['title'], f'chapter{index}'))
-        spine.append(chapter)
-
-    # Add images to the EPUB
-    for img_filename, img_data in process_content.epub_images:
-        epub_image = epub.EpubImage()
-        epub_image.file_name = img_filename
-        epub_image.media_type = 'image/jpeg'
-        epub_image.content = img_data
-        book.add_item(epub_image)
-
-    # Add default NCX and Nav file
-    book.add_item(epub.EpubNcx())
-    book.add_item(epub.EpubNav())
-
-    # Define Table of Contents
-    book.toc = toc
-
-    # Add chapters to the book
-    book.spine = spine
-
-    # Write EPUB file
-    epub.write_epub(epub_path, book, {})
-
-    return epub_path
\ No newline at end of file
+logger = logging.getLogger(__name__)
+
+CONTENT_DIR = 'EPUB'
+
+# Already-compressed payloads gain nothing from deflate, so they are stored as-is
+STORED_MEDIA_TYPES = {'image/jpeg', 'image/png', 'image/gif'}
+
+XML_NAME_RE = re.compile(r'^[A-Za-z_][\w.-]*$')
+
+CONTAINER_XML = f'''<?xml version="1.0" encoding="utf-8"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles>
+    <rootfile full-path="{CONTENT_DIR}/content.opf" media-type="application/oebps-package+xml"/>
+  </rootfiles>
+</container>
+'''
+
+def xhtml_document(title, body):
+    return f'''<?xml version="1.0" encoding="utf-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" lang="en" xml:lang="en">
+<head>
+  <title>{escape(title)}</title>
+</head>
+<body>
+{body}
+</body>
+</html>
+'''
+
+def to_xhtml(html):
+    """Make processed article HTML well-formed XHTML: no scripts, only XML-safe attribute names."""
+    soup = BeautifulSoup(html, 'html.parser')
+    for tag in soup.find_all(['script', 'noscript', 'iframe']):
+        tag.decompose()
+    for tag in soup.find_all(True):
+        for attr in list(tag.attrs):
+            if not XML_NAME_RE.match(attr):
+                del tag[attr]
+    return str(soup)
+
+@lru_cache(maxsize=None)
+def render_cover(cover_svg_path):
+    if not os.path.exists(cover_svg_path):
+        return None
+
+    # Convert SVG to PNG
+    from cairosvg import svg2png
+    png_data = svg2png(url=cover_svg_path)
+    cover_image = Image.open(io.BytesIO(png_data))
+
+    # Resize image if necessary
+    cover_image.thumbnail((1000, 1000))  # Adjust size as needed
+
+    # Save as JPEG
+    buffer = io.BytesIO()
+    cover_image.convert('RGB').save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+def build_chapter(article, processed_content):
+    body = f'''<h1>{escape(article['title'])}</h1>
+<p><em>By {escape(article['author'] or 'Unknown')}</em></p>
+{to_xhtml(processed_content)}'''
+    return xhtml_document(article['title'], body)
+
+def process_chapter(article, image_cache, processed_content=None):
+    try:
+        if processed_content is None:
+            processed_content = process_content(article['content'], image_cache, for_epub=True)
+        return build_chapter(article, processed_content)
+    except Exception as e:
+        logger.error(f"Error processing chapter {article['title']}: {e}")
+        return None
+
+class EpubWriter:
+    """
+    Write an EPUB container incrementally.
+
+    The mimetype entry goes first (stored, as the spec requires), then content
+    documents and images are appended as soon as they are ready. The package
+    document, navigation and NCX need the full manifest, so they are written by
+    close() once everything else is in the archive.
+    """
+
+    def __init__(self, path):
+        self.archive = zipfile.ZipFile(path, 'w')
+        self.manifest = []
+        self.written = set()
+        self.archive.writestr('mimetype', 'application/epub+zip', compress_type=zipfile.ZIP_STORED)
+        self.archive.writestr('META-INF/container.xml', CONTAINER_XML, compress_type=zipfile.ZIP_DEFLATED)
+
+    def add(self, item_id, href, data, media_type, properties=None):
+        if href in self.written:
+            return
+        compress_type = zipfile.ZIP_STORED if media_type in STORED_MEDIA_TYPES else zipfile.ZIP_DEFLATED
+        self.archive.writestr(f'{CONTENT_DIR}/{href}', data, compress_type=compress_type)
+        self.written.add(href)
+        self.manifest.append((item_id, href, media_type, properties))
+
+    def close(self, title, identifier, chapters, cover_id=None):
+        """Write the navigation documents and OPF for chapters, a list of (item_id, href, title)."""
+        nav_items = '\n'.join(f'      <li><a href="{href}">{escape(chapter_title)}</a></li>'
+                              for _, href, chapter_title in chapters)
+        nav_body = f'''<nav epub:type="toc" id="toc">
+  <h1>{escape(title)}</h1>
+  <ol>
+{nav_items}
+  </ol>
+</nav>'''
+        self.add('nav', 'nav.xhtml', xhtml_document(title, nav_body), 'application/xhtml+xml', 'nav')
+
+        nav_points = '\n'.join(f'''    <navPoint id="{item_id}" playOrder="{order}">
+      <navLabel><text>{escape(chapter_title)}</text></navLabel>
+      <content src="{href}"/>
+    </navPoint>''' for order, (item_id, href, chapter_title) in enumerate(chapters, start=1))
+        ncx = f'''<?xml version="1.0" encoding="utf-8"?>
+<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">
+  <head>
+    <meta name="dtb:uid" content="{identifier}"/>
+  </head>
+  <docTitle><text>{escape(title)}</text></docTitle>
+  <navMap>
+{nav_points}
+  </navMap>
+</ncx>
+'''
+        self.add('ncx', 'toc.ncx', ncx, 'application/x-dtbncx+xml')
+
+        manifest = '\n'.join(
+            f'    <item id="{item_id}" href="{href}" media-type="{media_type}"'
+            + (f' properties="{properties}"' if properties else '') + '/>'
+            for item_id, href, media_type, properties in self.manifest
+        )
+        spine = ['cover'] if cover_id else []
+        spine += ['nav'] + [item_id for item_id, _, _ in chapters]
+        itemrefs = '\n'.join(f'    <itemref idref="{item_id}"/>' for item_id in spine)
+        modified = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        cover_meta = f'\n    <meta name="cover" content="{cover_id}"/>' if cover_id else ''
+        opf = f'''<?xml version="1.0" encoding="utf-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="id">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+    <dc:identifier id="id">{identifier}</dc:identifier>
+    <dc:title>{escape(title)}</dc:title>
+    <dc:language>en</dc:language>
+    <dc:creator>Various</dc:creator>
+    <meta property="dcterms:modified">{modified}</meta>{cover_meta}
+  </metadata>
+  <manifest>
+{manifest}
+  </manifest>
+  <spine toc="ncx">
+{itemrefs}
+  </spine>
+</package>
+'''
+        self.archive.writestr(f'{CONTENT_DIR}/content.opf', opf, compress_type=zipfile.ZIP_DEFLATED)
+        self.archive.close()
+
+    def abort(self):
+        self.archive.close()
+
+def create_epub(articles, current_date, epub_path, image_cache=None, processed_articles=None,
+                release_images=None):
+    """
+    Build an EPUB from articles.
+
+    Chapters are processed concurrently and streamed into the archive as they
+    complete, together with any images they introduced. Each chapter is dropped
+    once written, and with release_images (the default when the image cache is
+    our own) so is each image's data, so the book is never held in memory as a
+    whole. image_cache and processed_articles may come from a shared processing
+    pass (see create_pdf), in which case articles are not processed again.
+    Chapters that fail are left out, as in the PDF.
+    """
+    title = f'Omnivore Articles {current_date}'
+    identifier = str(uuid.uuid4())
+
+    # Images are shared across all chapters of the book
+    owns_image_cache = image_cache is None
+    if owns_image_cache:
+        image_cache = ImageCache.from_config(current_app.config)
+    if release_images is None:
+        release_images = owns_image_cache
+
+    writer = EpubWriter(epub_path)
+    try:
+        # Add cover image
+        cover_id = None
+        cover_svg_path = os.path.join(current_app.root_path, 'static', 'images', 'cover.svg')
+        cover_data = render_cover(cover_svg_path)
+        if cover_data:
+            cover_id = 'cover-img'
+            writer.add(cover_id, 'cover.jpg', cover_data, 'image/jpeg', 'cover-image')
+            writer.add('cover', 'cover.xhtml',
+                       xhtml_document('Cover', '<img src="cover.jpg" alt="Cover" style="height: 100%"/>'),
+                       'application/xhtml+xml')
+
+        sources = processed_articles if processed_articles is not None else articles
+        chapters = [(f'chapter_{index}', f'chapter_{index}.xhtml', article['title'])
+                    for index, article in enumerate(sources, start=1)]
+
+        written = set()
+        with ThreadPoolExecutor(max_workers=5, initializer=profiled_thread_initializer()) as executor:
+            if processed_articles is None:
+                futures = {executor.submit(process_chapter, article, image_cache): index
+                           for index, article in enumerate(articles)}
+            else:
+                futures = {executor.submit(process_chapter, article, image_cache,
+                                           image_cache.uris_to_filenames(article['processed_content'])): index
+                           for index, article in enumerate(processed_articles)}
+
+            for future in as_completed(futures):
+                # Popped so the chapter's XHTML can be freed once it is in the archive
+                index = futures.pop(future)
+                chapter = future.result()
+                if chapter is None:
+                    continue
+                item_id, href, _ = chapters[index]
+                writer.add(item_id, href, chapter, 'application/xhtml+xml')
+                written.add(index)
+
+                # Stream out any images this chapter introduced
+                for digest, img_data, mime_type in image_cache.items():
+                    writer.add(f'img-{digest}', image_cache.filename(digest), img_data, mime_type)
+                    if release_images:
+                        image_cache.release(digest)
+
+        if not written:
+            raise ValueError("No chapters could be built")
+        chapters = [chapter for index, chapter in enumerate(chapters) if index in written]
+        writer.close(title, identifier, chapters, cover_id)
+    except Exception:
+        writer.abort()
+        raise
+
+    if owns_image_cache:
+        image_cache.log_report()
+
+    return epub_path
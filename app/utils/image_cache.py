@@ -0,0 +1,231 @@
+import hashlib
+import io
+import logging
+import re
+import threading
+from PIL import Image
+from app.utils.upstream import fetch_limited, UpstreamError
+
+logger = logging.getLogger(__name__)
+
+# URL scheme used to reference shared images from the generated PDF HTML.
+# The WeasyPrint url_fetcher resolves these back to the cached bytes, and
+# WeasyPrint caches images by URL, so each distinct image is embedded once.
+BUNDLE_IMAGE_SCHEME = "bundle-image"
+BUNDLE_IMAGE_URI_RE = re.compile(re.escape(BUNDLE_IMAGE_SCHEME) + r':([0-9a-f]+)')
+
+IMAGE_EXTENSIONS = {
+    'image/jpeg': 'jpg',
+    'image/png': 'png',
+    'image/gif': 'gif',
+}
+
+# Plenty of image hosts serve binary/octet-stream or application/octet-stream,
+# so rather than requiring image/* only responses that are clearly not images
+# (error pages, JSON) are refused before download; PIL decides about the rest
+NON_IMAGE_TYPES = ('text/', 'application/json', 'application/xhtml+xml')
+
+class ImageTooLarge(UpstreamError):
+    pass
+
+def fetch_image_data(url, max_bytes, timeout=5, deadline=15):
+    data, _ = fetch_limited(url, max_bytes, rejected_types=NON_IMAGE_TYPES, timeout=timeout, deadline=deadline)
+    return data
+
+def optimize_image_data(data, max_pixels, max_width=800, max_height=1000, quality=85):
+    # Only the header is read here; pixel data is decoded on first use
+    img = Image.open(io.BytesIO(data))
+    if img.width * img.height > max_pixels:
+        raise ImageTooLarge(f"{img.width}x{img.height} image exceeds {max_pixels} pixels")
+
+    # JPEGs can be decoded at 1/2, 1/4 or 1/8 scale directly, which avoids
+    # materialising a full-size camera image just to shrink it. Decoding to at
+    # least twice the target leaves the final resize enough detail.
+    if img.width > max_width or img.height > max_height:
+        img.draft('RGB', (max_width * 2, max_height * 2))
+
+    if img.mode not in ('RGB', 'RGBA'):
+        img = img.convert('RGB')
+
+    if img.width > max_width or img.height > max_height:
+        img.thumbnail((max_width, max_height), Image.LANCZOS)
+
+    if img.mode == 'RGBA':
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel('A'))
+        img = background
+
+    img_byte_arr = io.BytesIO()
+    img.save(img_byte_arr, format='JPEG', optimize=True, quality=quality)
+    return img_byte_arr.getvalue(), 'image/jpeg'
+
+class ImageCache:
+    """
+    Bundle-wide store of processed images.
+
+    Images are deduplicated by URL (each URL is fetched once, even when several
+    article threads ask for it at the same time) and by a hash of the
+    downloaded bytes (different URLs serving the same file are processed and
+    embedded once). Entries are addressed by that content digest. Images larger
+    than max_bytes to download or max_pixels to decode are dropped.
+    """
+
+    def __init__(self, max_width=800, max_height=1000, quality=85, *, max_bytes, max_pixels):
+        self.max_width = max_width
+        self.max_height = max_height
+        self.quality = quality
+        self.max_bytes = max_bytes
+        self.max_pixels = max_pixels
+
+        self._lock = threading.Lock()
+        self._by_url = {}
+        self._pending = {}
+        self._images = {}
+        self._sizes = {}
+
+        self.references = 0
+        self.url_hits = 0
+        self.content_hits = 0
+        self.bytes_saved = 0
+        self.bytes_downloaded = 0
+        self.rejected = 0
+
+    @classmethod
+    def from_config(cls, config, max_width=800, max_height=1000):
+        """Cache using the app's IMAGE_MAX_BYTES and IMAGE_MAX_PIXELS limits."""
+        return cls(max_width, max_height, max_bytes=config['IMAGE_MAX_BYTES'],
+                   max_pixels=config['IMAGE_MAX_PIXELS'])
+
+    def get(self, url):
+        """Return the digest of the processed image for url, or None if it failed."""
+        with self._lock:
+            self.references += 1
+            if url in self._by_url:
+                return self._record_url_hit(url)
+            event = self._pending.get(url)
+            owner = event is None
+            if owner:
+                event = self._pending[url] = threading.Event()
+
+        if not owner:
+            event.wait()
+            with self._lock:
+                return self._record_url_hit(url)
+
+        digest = None
+        try:
+            digest = self._load(url)
+        finally:
+            with self._lock:
+                self._by_url[url] = digest
+                self._pending.pop(url).set()
+        return digest
+
+    def _record_url_hit(self, url):
+        digest = self._by_url.get(url)
+        if digest is not None:
+            self.url_hits += 1
+            self.bytes_saved += self._sizes[digest]
+        return digest
+
+    def _load(self, url):
+        try:
+            raw = fetch_image_data(url, self.max_bytes)
+        except Exception as e:
+            logger.warning(f"Failed to fetch image: {url}. Error: {str(e)}")
+            if isinstance(e, UpstreamError):
+                with self._lock:
+                    self.rejected += 1
+            return None
+
+        digest = hashlib.sha256(raw).hexdigest()[:32]
+        with self._lock:
+            self.bytes_downloaded += len(raw)
+            if digest in self._images:
+                self.content_hits += 1
+                self.bytes_saved += self._sizes[digest]
+                return digest
+
+        try:
+            data, mime_type = optimize_image_data(raw, self.max_pixels, self.max_width, self.max_height,
+                                                  self.quality)
+        except Exception as e:
+            logger.warning(f"Failed to process image: {url}. Error: {str(e)}")
+            if isinstance(e, (ImageTooLarge, Image.DecompressionBombError)):
+                with self._lock:
+                    self.rejected += 1
+            return None
+
+        with self._lock:
+            if digest in self._images:
+                self.content_hits += 1
+                self.bytes_saved += self._sizes[digest]
+            else:
+                self._images[digest] = (data, mime_type)
+                self._sizes[digest] = len(data)
+        return digest
+
+    def lookup(self, digest):
+        """Return (data, mime_type) for a digest, or (None, None) if unknown."""
+        return self._images.get(digest, (None, None))
+
+    def uri(self, digest):
+        return f"{BUNDLE_IMAGE_SCHEME}:{digest}"
+
+    def resolve_uri(self, uri):
+        """Return (data, mime_type) for a bundle-image URI, or (None, None)."""
+        prefix = f"{BUNDLE_IMAGE_SCHEME}:"
+        if not uri.startswith(prefix):
+            return None, None
+        return self.lookup(uri[len(prefix):])
+
+    def filename(self, digest):
+        _, mime_type = self.lookup(digest)
+        return f"images/{digest}.{IMAGE_EXTENSIONS.get(mime_type, 'jpg')}"
+
+    def uris_to_filenames(self, html):
+        """Rewrite bundle-image URIs in processed HTML to the file names used inside an EPUB."""
+        return BUNDLE_IMAGE_URI_RE.sub(lambda match: self.filename(match.group(1)), html)
+
+    def embedded(self, html):
+        """Return (count, bytes) of the distinct images referenced by processed HTML."""
+        digests = set(BUNDLE_IMAGE_URI_RE.findall(html))
+        sizes = [self._sizes[digest] for digest in digests if digest in self._sizes]
+        return len(sizes), sum(sizes)
+
+    def release(self, digest):
+        """Drop an image's data once it has been written out; its type and size are kept."""
+        with self._lock:
+            if digest in self._images:
+                self._images[digest] = (None, self._images[digest][1])
+
+    def items(self):
+        """Yield (digest, data, mime_type) for every distinct image not yet released."""
+        with self._lock:
+            images = list(self._images.items())
+        for digest, (data, mime_type) in images:
+            if data is not None:
+                yield digest, data, mime_type
+
+    def report(self):
+        with self._lock:
+            return {
+                'images': len(self._images),
+                'references': self.references,
+                'url_hits': self.url_hits,
+                'content_hits': self.content_hits,
+                'embedded_bytes': sum(self._sizes.values()),
+                'bytes_saved': self.bytes_saved,
+                'bytes_downloaded': self.bytes_downloaded,
+                'rejected': self.rejected,
+            }
+
+    def log_report(self):
+        report = self.report()
+        logger.info(
+            f"Images: {report['images']} distinct from {report['references']} references "
+            f"({report['url_hits']} URL duplicates, {report['content_hits']} content duplicates), "
+            f"{report['embedded_bytes']} bytes embedded, {report['bytes_saved']} bytes saved, "
+            f"{report['bytes_downloaded']} bytes downloaded, {report['rejected']} rejected by size or type limits"
+        )
+        return report
@@ -0,0 +1,36 @@
+import time
+from app.utils.state import KEY_PREFIX
+
+JOBS_PREFIX = f'{KEY_PREFIX}jobs:'
+
+class JobRegistry:
+    """
+    Document generation jobs, visible to every worker through the state backend.
+
+    Records expire after ttl seconds so finished jobs don't accumulate. Updates
+    are atomic read-modify-writes, so fields written from different places are
+    never lost.
+    """
+
+    def __init__(self, backend, ttl=3600):
+        self.backend = backend
+        self.ttl = ttl
+
+    def _key(self, job_id):
+        return f'{JOBS_PREFIX}{job_id}'
+
+    def start(self, job_id, **fields):
+        job = dict(fields, id=job_id, status='running', started=time.time())
+        self.backend.set_json(self._key(job_id), job, self.ttl)
+        return job
+
+    def update(self, job_id, **fields):
+        """Merge fields into a started job; returns None, writing nothing, if there is no such job."""
+        return self.backend.update_json(self._key(job_id), lambda job: dict(job, **fields) if job else None,
+                                        self.ttl)
+
+    def finish(self, job_id, status='done', **fields):
+        return self.update(job_id, status=status, finished=time.time(), **fields)
+
+    def get(self, job_id):
+        return self.backend.get_json(self._key(job_id))
@@ -0,0 +1,44 @@
+import time
+from limits.storage import Storage
+from app.utils.state import KEY_PREFIX, StateBackendError, create_state_backend
+
+LIMITS_PREFIX = f'{KEY_PREFIX}limits:'
+
+class StateBackendStorage(Storage):
+    """
+    Flask-Limiter storage on top of the shared state backend, so every worker
+    counts against the same limits.
+
+    Selected with RATELIMIT_STORAGE_URI = "state+<state backend URI>", e.g.
+    state+sqlite:///var/lib/omnivore/state.db or state+redis://localhost:6379/0.
+    Importing this module registers the scheme with limits.
+    """
+
+    STORAGE_SCHEME = ['state+sqlite', 'state+redis']
+
+    def __init__(self, uri=None, wrap_exceptions=False, **options):
+        super().__init__(uri, wrap_exceptions=wrap_exceptions, **options)
+        self.backend = create_state_backend(uri[len('state+'):])
+
+    @property
+    def base_exceptions(self):
+        return (StateBackendError, OSError)
+
+    def incr(self, key, expiry, elastic_expiry=False, amount=1):
+        return self.backend.incr(LIMITS_PREFIX + key, amount, ttl=expiry, refresh_ttl=elastic_expiry)
+
+    def get(self, key):
+        value = self.backend.get(LIMITS_PREFIX + key)
+        return int(value) if value is not None else 0
+
+    def get_expiry(self, key):
+        return self.backend.expiry(LIMITS_PREFIX + key) or time.time()
+
+    def check(self):
+        return self.backend.check()
+
+    def reset(self):
+        return self.backend.reset(LIMITS_PREFIX)
+
+    def clear(self, key):
+        self.backend.delete(LIMITS_PREFIX + key)
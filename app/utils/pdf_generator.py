@@ -2,9 +2,7 @@ import logging
 import subprocess
 import base64
 import os
-import io
-import requests
-from PIL import Image
+from functools import partial, lru_cache
 from weasyprint import HTML, urls
 from weasyprint.text.fonts import FontConfiguration
 from bs4 import BeautifulSoup
@@ -12,16 +10,29 @@ from urllib.parse import urlparse
 from flask import current_app
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from app import socketio
+from app.utils.image_cache import ImageCache, BUNDLE_IMAGE_SCHEME
+from app.utils.upstream import fetch_limited, content_type
+from app.utils.responsive_images import select_image_source
+from app.utils.device_profiles import get_profile, image_target_width
+from app.utils.profiling import timed_subprocess, profiled_thread_initializer
 
 logger = logging.getLogger(__name__)
 
+# Fonts and the cover are static, so they are read once per process (or once in a
+# preloading master, see app/utils/startup.py) and shared by every render.
+@lru_cache(maxsize=None)
 def encode_font(font_path):
     with open(font_path, "rb") as font_file:
         return base64.b64encode(font_file.read()).decode('utf-8')
 
+@lru_cache(maxsize=None)
+def read_cover_svg(cover_svg_path):
+    with open(cover_svg_path, 'r') as svg_file:
+        return svg_file.read()
+
 def compress_pdf(input_path, output_path):
     try:
-        subprocess.run([
+        timed_subprocess('gs', subprocess.run, [
             'gs', '-sDEVICE=pdfwrite', '-dCompatibilityLevel=1.4',
             '-dPDFSETTINGS=/ebook', '-dNOPAUSE', '-dQUIET', '-dBATCH',
             f'-sOutputFile={output_path}', input_path
@@ -47,46 +58,30 @@ def is_valid_image_url(url):
     except ValueError:
         return False
 
-def process_content(content, for_epub=False):
+def process_content(content, image_cache, for_epub=False, target_width=None):
     soup = BeautifulSoup(content, 'html.parser')
+    target_width = target_width or image_cache.max_width
     
     for img in soup.find_all('img'):
-        src = img.get('src')
+        src = select_image_source(img, target_width, url_filter=is_valid_image_url)
+        for attr in ('srcset', 'data-srcset', 'sizes', 'data-src'):
+            if img.has_attr(attr):
+                del img[attr]
+        picture = img.find_parent('picture')
+        if picture:
+            for source in picture.find_all('source'):
+                source.decompose()
         if not src or not is_valid_image_url(src):
             logger.warning(f"Removing invalid image URL: {src}")
             img.decompose()
             continue
 
-        if for_epub:
-            try:
-                response = requests.get(src)
-                if response.status_code == 200:
-                    # Generate a unique filename for the image
-                    img_filename = f"image_{hash(src)}.jpg"
-                    
-                    # Save the image data
-                    img_data = response.content
-                    
-                    # Replace the src with the new filename
-                    img['src'] = img_filename
-                    
-                    # Store the image data to be added to the EPUB later
-                    if not hasattr(process_content, 'epub_images'):
-                        process_content.epub_images = []
-                    process_content.epub_images.append((img_filename, img_data))
-                else:
-                    logger.warning(f"Failed to fetch image: {src}")
-                    img.decompose()
-            except Exception as e:
-                logger.error(f"Error processing image {src}: {str(e)}")
-                img.decompose()
+        # Images are fetched and processed once per bundle; repeats share the cached copy
+        digest = image_cache.get(src)
+        if digest:
+            img['src'] = image_cache.filename(digest) if for_epub else image_cache.uri(digest)
         else:
-            # Existing image processing for PDF
-            optimized_image, mime_type = optimize_image(src)
-            if optimized_image:
-                img['src'] = f"data:{mime_type};base64,{base64.b64encode(optimized_image).decode('utf-8')}"
-            else:
-                img.decompose()
+            img.decompose()
 
     for figure in soup.find_all('figure'):
         if figure.has_attr('class'):
@@ -111,29 +106,29 @@ def process_content(content, for_epub=False):
     
     return str(soup)
 
-def optimize_image(url, max_width=800, max_height=1000, quality=85):
-    try:
-        response = requests.get(url, timeout=5)
-        img = Image.open(io.BytesIO(response.content))
-        
-        if img.mode not in ('RGB', 'RGBA'):
-            img = img.convert('RGB')
-        
-        if img.width > max_width or img.height > max_height:
-            img.thumbnail((max_width, max_height), Image.LANCZOS)
-        
-        img_byte_arr = io.BytesIO()
-        img.save(img_byte_arr, format='JPEG', optimize=True, quality=quality)
-        return img_byte_arr.getvalue(), 'image/jpeg'
-    except Exception as e:
-        logger.warning(f"Failed to process image: {url}. Error: {str(e)}")
-        return None, None
-
-def fetch_url_wrapper(url):
+def fetch_url_wrapper(url, image_cache):
     try:
-        result = urls.default_url_fetcher(url)
+        if url.startswith(f"{BUNDLE_IMAGE_SCHEME}:"):
+            data, mime_type = image_cache.resolve_uri(url)
+            if data:
+                return {
+                    'string': data,
+                    'mime_type': mime_type
+                }
+            return None
+        if urlparse(url).scheme in ('http', 'https'):
+            # Remote resources are read with the image size cap instead of WeasyPrint's unbounded fetch
+            body, response = fetch_limited(url, image_cache.max_bytes)
+            result = {
+                'string': body,
+                'mime_type': content_type(response) or 'application/octet-stream',
+                'encoding': response.encoding,
+                'redirected_url': response.url,
+            }
+        else:
+            result = urls.default_url_fetcher(url)
         if result['mime_type'].startswith('image/'):
-            optimized_image, mime_type = optimize_image(url)
+            optimized_image, mime_type = image_cache.lookup(image_cache.get(url))
             if optimized_image:
                 return {
                     'string': optimized_image,
@@ -144,10 +139,11 @@ def fetch_url_wrapper(url):
         logger.warning(f"Failed to fetch URL: {url}. Error: {str(e)}")
         return None
 
-def process_article_content(article, article_index, total_articles):
+def process_article_content(article, article_index, total_articles, image_cache, target_width=None):
     try:
-        processed_content = process_content(article['content'])
+        processed_content = process_content(article['content'], image_cache, target_width=target_width)
         return {
+            'id': article.get('id'),
             'title': article['title'],
             'author': article['author'],
             'url': article['url'],
@@ -157,7 +153,42 @@ def process_article_content(article, article_index, total_articles):
         logger.error(f"Error processing article {article['title']}: {e}")
         return None
 
-def create_pdf(articles, current_date, pdf_path, two_column_layout=False):
+def process_articles(articles, image_cache, target_width=None):
+    """Process all articles in parallel, returning results in the original article order."""
+    processed_articles = []
+    total_articles = len(articles)
+    with ThreadPoolExecutor(max_workers=5, initializer=profiled_thread_initializer()) as executor:
+        future_to_article = {executor.submit(process_article_content, article, index, total_articles, image_cache, target_width): article 
+                             for index, article in enumerate(articles)}
+        for future in as_completed(future_to_article):
+            result = future.result()
+            if result:
+                processed_articles.append(result)
+                progress = 20 + (len(processed_articles) / total_articles) * 40
+                socketio.emit('pdf_progress', {'progress': progress, 'status': f'Processed {len(processed_articles)} of {total_articles} articles'})
+
+    # Sort processed articles to maintain original order
+    processed_articles.sort(key=lambda x: articles.index(next(a for a in articles if a['title'] == x['title'])))
+    return processed_articles
+
+def create_pdf(articles, current_date, pdf_path, two_column_layout=False, profile=None, image_cache=None, processed_articles=None,
+               compress=True):
+    """
+    Render articles to a PDF laid out for a device profile.
+
+    image_cache and processed_articles may be shared between several renders of
+    the same bundle, so articles and images are only fetched and processed once.
+    With compress=False the raw WeasyPrint output is returned, for callers that
+    post-process it themselves.
+    """
+    profile = profile or get_profile(two_column_layout=two_column_layout)
+    two_column_layout = profile['columns'] > 1
+    font_scale = profile['font_scale']
+    font_sizes = profile.get('font_sizes', {})
+
+    def font_px(element, size):
+        return f"{font_sizes.get(element, size * font_scale):g}px"
+
     socketio.emit('pdf_progress', {'progress': 0, 'status': 'Starting PDF generation'})
     
     socketio.emit('pdf_progress', {'progress': 5, 'status': 'Loading fonts and cover'})
@@ -167,33 +198,32 @@ def create_pdf(articles, current_date, pdf_path, two_column_layout=False):
     
     cover_svg_path = os.path.join(current_app.root_path, 'static', 'images', 'cover.svg')
     try:
-        with open(cover_svg_path, 'r') as svg_file:
-            cover_svg = svg_file.read()
+        cover_svg = read_cover_svg(cover_svg_path)
     except Exception as e:
         logger.error(f"Error reading cover SVG: {e}")
         cover_svg = None
 
     socketio.emit('pdf_progress', {'progress': 10, 'status': 'Preparing HTML content'})
     
-    page_width_px = 810
-    page_height_px = 1080
+    page_width_px = profile['page_width']
+    page_height_px = profile['page_height']
 
-    column_css = """
-    .article-content {
-        column-count: 2;
+    column_css = f"""
+    .article-content {{
+        column-count: {profile['columns']};
         column-gap: 20px;
         text-align: justify;
-    }
-    .article-content img {
+    }}
+    .article-content img {{
         max-width: 100%;
         height: auto;
         display: block;
         margin: 10px auto;
         page-break-inside: avoid;
-    }
-    .article-header {
+    }}
+    .article-header {{
         column-span: all;
-    }
+    }}
     """ if two_column_layout else ""
 
     html_content = f"""
@@ -220,14 +250,14 @@ def create_pdf(articles, current_date, pdf_path, two_column_layout=False):
             }}
             @page {{
                 size: {page_width_px}px {page_height_px}px;
-                margin: {'50px 25px' if two_column_layout else '50px 50px'};
+                margin: {profile['margin_vertical']}px {profile['margin_horizontal']}px;
             }}
             @page :first {{
                 margin: 0;
             }}
             body {{ 
                 font-family: 'Lexend', sans-serif; 
-                font-size: {'13.5px' if two_column_layout else '15px'}; 
+                font-size: {font_px('body', 15)}; 
                 line-height: 1.5; 
                 margin: 0;
                 padding: 0;
@@ -249,7 +279,7 @@ def create_pdf(articles, current_date, pdf_path, two_column_layout=False):
             }}
             h1 {{ 
                 font-family: 'Bookerly', serif; 
-                font-size: {'24px' if two_column_layout else '26px'}; 
+                font-size: {font_px('h1', 26)}; 
                 font-weight: bold; 
                 margin-top: 20px;
                 margin-bottom: {'10px' if two_column_layout else '20px'};
@@ -257,7 +287,7 @@ def create_pdf(articles, current_date, pdf_path, two_column_layout=False):
             }}
             h2 {{ 
                 font-family: 'Bookerly', serif; 
-                font-size: 20px; 
+                font-size: {font_px('h2', 20)}; 
                 font-weight: bold; 
                 margin-top: 25px;
                 margin-bottom: 15px;
@@ -268,7 +298,7 @@ def create_pdf(articles, current_date, pdf_path, two_column_layout=False):
             }}
             .metadata {{ 
                 font-family: 'Lexend', sans-serif;
-                font-size: 12px; 
+                font-size: {font_px('metadata', 12)}; 
                 color: #666; 
                 margin-bottom: 10px;
             }}
@@ -293,7 +323,7 @@ def create_pdf(articles, current_date, pdf_path, two_column_layout=False):
                 border-radius: 5px;
             }}
             .image-caption {{
-                font-size: 12px;
+                font-size: {font_px('caption', 12)};
                 color: #666;
                 margin-top: 10px;
                 font-style: italic;
@@ -318,7 +348,7 @@ def create_pdf(articles, current_date, pdf_path, two_column_layout=False):
                 padding: {'1.5rem' if two_column_layout else '0rem'};
             }}
             .toc h1 {{
-                font-size: 28px;
+                font-size: {font_px('toc-h1', 28)};
             }}
             .toc a {{
                 text-decoration: none;
@@ -328,7 +358,7 @@ def create_pdf(articles, current_date, pdf_path, two_column_layout=False):
             .toc ul {{
                 list-style-type: none;
                 padding-left: 0;
-                font-size: 15px;
+                font-size: {font_px('toc-list', 15)};
             }}
             .toc li {{
                 margin-bottom: 10px;
@@ -352,21 +382,13 @@ def create_pdf(articles, current_date, pdf_path, two_column_layout=False):
 
     socketio.emit('pdf_progress', {'progress': 20, 'status': 'Processing articles'})
 
-    # Process articles in parallel
-    processed_articles = []
-    total_articles = len(articles)
-    with ThreadPoolExecutor(max_workers=5) as executor:
-        future_to_article = {executor.submit(process_article_content, article, index, total_articles): article 
-                             for index, article in enumerate(articles)}
-        for future in as_completed(future_to_article):
-            result = future.result()
-            if result:
-                processed_articles.append(result)
-                progress = 20 + (len(processed_articles) / total_articles) * 40
-                socketio.emit('pdf_progress', {'progress': progress, 'status': f'Processed {len(processed_articles)} of {total_articles} articles'})
-
-    # Sort processed articles to maintain original order
-    processed_articles.sort(key=lambda x: articles.index(next(a for a in articles if a['title'] == x['title'])))
+    # Process articles in parallel, unless a shared pass has already done so
+    owns_image_cache = image_cache is None
+    if owns_image_cache:
+        image_cache = ImageCache.from_config(current_app.config, profile['image_max_width'],
+                                             profile['image_max_height'])
+    if processed_articles is None:
+        processed_articles = process_articles(articles, image_cache, image_target_width(profile))
 
     socketio.emit('pdf_progress', {'progress': 60, 'status': 'Generating Table of Contents'})
     # Generate Table of Contents
@@ -404,7 +426,7 @@ def create_pdf(articles, current_date, pdf_path, two_column_layout=False):
             pdf_path,
             font_config=font_config,
             presentational_hints=True,
-            url_fetcher=fetch_url_wrapper,
+            url_fetcher=partial(fetch_url_wrapper, image_cache=image_cache),
             metadata={
                 'title': f'Omnivore {current_date}',
                 'author': 'Various',
@@ -412,6 +434,11 @@ def create_pdf(articles, current_date, pdf_path, two_column_layout=False):
             }
         )
         logger.info(f"PDF created successfully: {pdf_path}")
+        if owns_image_cache:
+            image_cache.log_report()
+        if not compress:
+            socketio.emit('pdf_progress', {'progress': 100, 'status': 'PDF generation complete'})
+            return pdf_path
         socketio.emit('pdf_progress', {'progress': 90, 'status': 'Compressing PDF'})
         
         # Compress PDF
@@ -0,0 +1,239 @@
+import cProfile
+import hmac
+import io
+import logging
+import os
+import pstats
+import threading
+import time
+from collections import defaultdict
+from html import escape
+
+logger = logging.getLogger(__name__)
+
+PROFILE_FILES = {
+    'pstats': ('profile.pstats', 'application/octet-stream'),
+    'folded': ('stacks.folded', 'text/plain'),
+    'flamegraph': ('flamegraph.svg', 'image/svg+xml'),
+    'summary': ('summary.txt', 'text/plain'),
+}
+
+# The profiler each thread reports to: the request thread that started it and
+# the executor threads that request spawned (see profiled_thread_initializer)
+_local = threading.local()
+
+def profiling_authorised(config, headers):
+    """Profiles are admin-only: PROFILING_ENABLED and a matching X-Admin-Token are both required."""
+    token = config.get('PROFILING_ADMIN_TOKEN')
+    if not config.get('PROFILING_ENABLED') or not token:
+        return False
+    return hmac.compare_digest(headers.get('X-Admin-Token', ''), token)
+
+def profiling_allowed(config, headers, data):
+    """Profile this request if authorised and opted in by header or job flag."""
+    if not profiling_authorised(config, headers):
+        return False
+    return headers.get('X-Profile') == '1' or bool(data and data.get('profile'))
+
+def current_profiler():
+    return getattr(_local, 'profiler', None)
+
+def profiled_thread_initializer():
+    """
+    ThreadPoolExecutor initializer that profiles the pool's threads for the
+    calling thread's profiler, or None if the caller is not being profiled.
+
+    Only threads started this way are profiled, so work from other requests
+    running at the same time never ends up in this request's profile.
+    """
+    profiler = current_profiler()
+    return profiler.start_thread if profiler else None
+
+def record_subprocess(name, seconds):
+    profiler = current_profiler()
+    if profiler:
+        with profiler._lock:
+            profiler.subprocesses[name].append(seconds)
+
+def timed_subprocess(name, func, *args, **kwargs):
+    """Run a subprocess call and report its wall time to the calling thread's profiler, if any."""
+    start = time.perf_counter()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        record_subprocess(name, time.perf_counter() - start)
+
+class RequestProfiler:
+    """
+    Profile everything a request does, including threads it starts.
+
+    The request thread is profiled with cProfile. Executors created during the
+    request pass profiled_thread_initializer(), so each of their threads starts
+    its own cProfile. All of them are merged into one pstats file when the
+    profiler stops. Ghostscript and other subprocess wall time is recorded
+    separately via timed_subprocess.
+    """
+
+    def __init__(self, profile_dir, job_id):
+        self.job_id = job_id
+        self.output_dir = os.path.join(profile_dir, job_id)
+        self.profilers = []
+        self.subprocesses = defaultdict(list)
+        self._lock = threading.Lock()
+        self._started = None
+        self.wall_time = None
+
+    def start_thread(self):
+        # Nested executors started from this thread report to the same profiler
+        _local.profiler = self
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Python 3.12+ allows one active profiler, which already sees all threads
+            return
+        with self._lock:
+            self.profilers.append(profiler)
+
+    def __enter__(self):
+        self._previous = current_profiler()
+        _local.profiler = self
+        self._main = cProfile.Profile()
+        self.profilers.append(self._main)
+        self._started = time.perf_counter()
+        self._main.enable()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._main.disable()
+        self.wall_time = time.perf_counter() - self._started
+        _local.profiler = self._previous
+        try:
+            self.save()
+        except Exception as e:
+            logger.exception(f"Failed to save profile {self.job_id}: {e}")
+        return False
+
+    def stats(self):
+        stats = None
+        with self._lock:
+            profilers = list(self.profilers)
+        for profiler in profilers:
+            profiler.disable()
+            profiler.create_stats()
+            if not profiler.stats:
+                continue
+            if stats is None:
+                stats = pstats.Stats(profiler)
+            else:
+                stats.add(profiler)
+        return stats
+
+    def save(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        stats = self.stats()
+        if stats is None:
+            return
+
+        stats.dump_stats(self.path('pstats'))
+        folded = folded_stacks(stats)
+        with open(self.path('folded'), 'w') as folded_file:
+            folded_file.writelines(f"{stack} {value}\n" for stack, value in folded)
+        with open(self.path('flamegraph'), 'w') as svg_file:
+            svg_file.write(flamegraph_svg(folded, title=f"generate_document {self.job_id}"))
+        with open(self.path('summary'), 'w') as summary_file:
+            summary_file.write(self.summary(stats))
+        logger.warning(f"Profile {self.job_id} saved to {self.output_dir}")
+
+    def path(self, kind):
+        return os.path.join(self.output_dir, PROFILE_FILES[kind][0])
+
+    def summary(self, stats):
+        output = io.StringIO()
+        output.write(f"Wall time: {self.wall_time:.3f}s across {len(self.profilers)} profiled threads\n")
+        for name, timings in sorted(self.subprocesses.items()):
+            output.write(f"Subprocess {name}: {len(timings)} runs, {sum(timings):.3f}s wall time\n")
+        output.write("\n")
+        stats.stream = output
+        stats.sort_stats('cumulative').print_stats(40)
+        return output.getvalue()
+
+def function_label(func):
+    filename, line, name = func
+    if filename == '~':
+        return name
+    return f"{name} ({os.path.basename(filename)}:{line})"
+
+def folded_stacks(stats, min_microseconds=1000):
+    """
+    Approximate folded call stacks from pstats caller data, for flame graphs.
+
+    pstats keeps only caller/callee pairs, so time is split down the tree in
+    proportion to each edge's cumulative time, as flameprof does.
+    """
+    callees = defaultdict(dict)
+    roots = []
+    for func, (_, _, _, cumulative, callers) in stats.stats.items():
+        if not callers:
+            roots.append(func)
+        for caller, edge in callers.items():
+            callees[caller][func] = edge[3]
+
+    folded = defaultdict(int)
+
+    def walk(func, share, stack):
+        _, _, total, cumulative, _ = stats.stats[func]
+        if cumulative <= 0 or share * 1e6 < min_microseconds:
+            return
+        scale = share / cumulative
+        stack = stack + [function_label(func)]
+        self_time = total * scale
+        if self_time * 1e6 >= min_microseconds:
+            folded[';'.join(stack)] += int(self_time * 1e6)
+        for callee, edge_time in callees.get(func, {}).items():
+            if function_label(callee) not in stack:
+                walk(callee, edge_time * scale, stack)
+
+    for root in roots:
+        walk(root, stats.stats[root][3], [])
+    return sorted(folded.items())
+
+def flamegraph_svg(folded, title, width=1200, row_height=16):
+    """Render folded stacks as a static SVG flame graph (widths in microseconds)."""
+    tree = {}
+    for stack, value in folded:
+        node = tree
+        for frame in stack.split(';'):
+            entry = node.setdefault(frame, [0, {}])
+            entry[0] += value
+            node = entry[1]
+
+    total = sum(entry[0] for entry in tree.values()) or 1
+    rects = []
+
+    def layout(node, x, depth):
+        for frame, (value, children) in sorted(node.items()):
+            frame_width = value / total * width
+            if frame_width >= 0.5:
+                rects.append((x, depth, frame_width, frame, value))
+                layout(children, x, depth + 1)
+            x += frame_width
+
+    layout(tree, 0, 0)
+    max_depth = max((depth for _, depth, _, _, _ in rects), default=0)
+    height = (max_depth + 3) * row_height
+    parts = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" font-family="monospace" font-size="11">',
+        f'<text x="4" y="{row_height - 4}">{escape(title)} ({total / 1e6:.3f}s profiled)</text>',
+    ]
+    for x, depth, frame_width, frame, value in rects:
+        y = height - (depth + 1) * row_height
+        hue = 20 + (hash(frame) % 40)
+        label = escape(frame[:int(frame_width / 7)]) if frame_width > 21 else ''
+        parts.append(
+            f'<g><title>{escape(frame)} ({value / 1000:.1f} ms, {value / total:.1%})</title>'
+            f'<rect x="{x:.1f}" y="{y}" width="{frame_width:.1f}" height="{row_height - 1}" fill="hsl({hue},90%,60%)"/>'
+            f'<text x="{x + 2:.1f}" y="{y + row_height - 4}">{label}</text></g>'
+        )
+    parts.append('</svg>')
+    return '\n'.join(parts)
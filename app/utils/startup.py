@@ -0,0 +1,82 @@
+import gc
+import importlib
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+# Modules only needed to build documents; routes that just render templates
+# never import them, so they are either loaded lazily per worker or once in a
+# preloading master (see gunicorn.conf.py).
+DOCUMENT_STACK_MODULES = [
+    'PIL.Image',
+    'requests',
+    'bs4',
+    'weasyprint',
+    'cairosvg',
+    'app.utils.document_job',
+]
+
+def timed(timings, name, func, *args):
+    start = time.perf_counter()
+    try:
+        return func(*args)
+    except Exception as e:
+        logger.warning(f"Warm-up step {name} failed: {e}")
+        return None
+    finally:
+        timings.append((name, time.perf_counter() - start))
+
+def warm_up(app):
+    """
+    Import the document stack and load static assets into this process.
+
+    Run in the gunicorn master with preload_app, the imported modules, fonts,
+    covers and the initialised fontconfig cache are inherited copy-on-write by
+    every forked worker instead of being rebuilt in each. Green workers, which
+    do not preload, run it themselves once monkey-patched. Returns a list of
+    (step, seconds).
+    """
+    timings = []
+    for module in DOCUMENT_STACK_MODULES:
+        timed(timings, f"import {module}", importlib.import_module, module)
+
+    from weasyprint.text.fonts import FontConfiguration
+    from app.utils.pdf_generator import encode_font, read_cover_svg
+    from app.utils.epub_generator import render_cover
+
+    with app.app_context():
+        font_dir = app.config['FONT_DIR']
+        cover_svg_path = os.path.join(app.root_path, 'static', 'images', 'cover.svg')
+        for font in ('Bookerly-Regular.ttf', 'Bookerly-Bold.ttf', 'Lexend-Regular.ttf'):
+            timed(timings, f"font {font}", encode_font, os.path.join(font_dir, font))
+        timed(timings, "cover svg", read_cover_svg, cover_svg_path)
+        timed(timings, "epub cover", render_cover, cover_svg_path)
+        # The first FontConfiguration initialises fontconfig and scans system fonts
+        timed(timings, "fontconfig", FontConfiguration)
+
+    return timings
+
+def freeze_for_fork():
+    """Move everything allocated so far out of the GC's reach so forked workers don't dirty shared pages."""
+    gc.collect()
+    gc.freeze()
+
+def format_report(timings):
+    width = max((len(name) for name, _ in timings), default=0)
+    lines = [f"{name.ljust(width)}  {seconds * 1000:8.1f} ms" for name, seconds in timings]
+    lines.append(f"{'total'.ljust(width)}  {sum(seconds for _, seconds in timings) * 1000:8.1f} ms")
+    return '\n'.join(lines)
+
+def log_report(timings):
+    logger.warning(f"Startup warm-up:\n{format_report(timings)}")
+
+if __name__ == '__main__':
+    # python -m app.utils.startup: measure the cold cost of app creation and warm-up
+    start = time.perf_counter()
+    from app import create_app
+    app = create_app()
+    timings = [("create_app", time.perf_counter() - start)]
+    timings += warm_up(app)
+    print(format_report(timings))
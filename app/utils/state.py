@@ -0,0 +1,404 @@
+import json
+import logging
+import os
+import random
+import socket
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from functools import lru_cache
+from urllib.parse import urlparse, unquote
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = 'omnivore:'
+
+class StateBackendError(Exception):
+    pass
+
+class StateBackend(ABC):
+    """
+    Key/value state shared by every worker process: rate-limit counters, the
+    job registry and caches.
+
+    Values are bytes; counters are integers. ttl is in seconds. Every operation
+    is atomic on its own, so callers never need to lock across workers.
+    """
+
+    @abstractmethod
+    def get(self, key):
+        pass
+
+    @abstractmethod
+    def set(self, key, value, ttl=None):
+        pass
+
+    @abstractmethod
+    def add(self, key, value, ttl=None):
+        """Set key only if it does not exist; return True if it was set."""
+
+    @abstractmethod
+    def delete(self, key):
+        pass
+
+    @abstractmethod
+    def incr(self, key, amount=1, ttl=None, refresh_ttl=False):
+        """Atomically add amount to a counter, starting it (with ttl) if it does not exist."""
+
+    @abstractmethod
+    def expiry(self, key):
+        """Return the key's expiry as a Unix timestamp, or None if it has none or does not exist."""
+
+    @abstractmethod
+    def reset(self, prefix=''):
+        """Delete every key starting with prefix; return the number deleted."""
+
+    def check(self):
+        try:
+            self.get('__check__')
+            return True
+        except Exception:
+            return False
+
+    def get_json(self, key):
+        value = self.get(key)
+        return json.loads(value) if value is not None else None
+
+    def set_json(self, key, value, ttl=None):
+        self.set(key, json.dumps(value), ttl)
+
+    @abstractmethod
+    def update_json(self, key, update, ttl=None):
+        """
+        Atomically replace a JSON value with update(current), where current is
+        None if the key does not exist. If update returns None nothing is
+        written. Returns the new value.
+        """
+
+def _as_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode('utf-8')
+
+class SQLiteStateBackend(StateBackend):
+    """
+    State in a single SQLite file in WAL mode, for single-host deployments.
+
+    Each thread (or green thread) in each process has its own connection;
+    atomicity comes from single-statement upserts.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._local = threading.local()
+        self._returning = sqlite3.sqlite_version_info >= (3, 35)
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS state "
+                "(key TEXT PRIMARY KEY, value BLOB, expires REAL)"
+            )
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        # Connections must not be shared with forked workers
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _expires(self, ttl):
+        return time.time() + ttl if ttl else None
+
+    def _maybe_purge(self, conn):
+        if random.random() < 0.01:
+            conn.execute("DELETE FROM state WHERE expires IS NOT NULL AND expires <= ?", (time.time(),))
+
+    def get(self, key):
+        row = self._connection().execute(
+            "SELECT value FROM state WHERE key = ? AND (expires IS NULL OR expires > ?)",
+            (key, time.time())
+        ).fetchone()
+        return _as_bytes(row[0]) if row else None
+
+    def set(self, key, value, ttl=None):
+        conn = self._connection()
+        conn.execute(
+            "INSERT INTO state (key, value, expires) VALUES (?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value, expires = excluded.expires",
+            (key, _as_bytes(value), self._expires(ttl))
+        )
+        self._maybe_purge(conn)
+
+    def add(self, key, value, ttl=None):
+        now = time.time()
+        cursor = self._connection().execute(
+            "INSERT INTO state (key, value, expires) VALUES (?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value, expires = excluded.expires "
+            "WHERE state.expires IS NOT NULL AND state.expires <= ?",
+            (key, _as_bytes(value), self._expires(ttl), now)
+        )
+        return cursor.rowcount == 1
+
+    def delete(self, key):
+        self._connection().execute("DELETE FROM state WHERE key = ?", (key,))
+
+    def incr(self, key, amount=1, ttl=None, refresh_ttl=False):
+        now = time.time()
+        upsert = (
+            "INSERT INTO state (key, value, expires) VALUES (?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET "
+            "value = CASE WHEN state.expires IS NOT NULL AND state.expires <= ? "
+            "THEN excluded.value ELSE CAST(state.value AS INTEGER) + excluded.value END, "
+            "expires = CASE WHEN ? OR (state.expires IS NOT NULL AND state.expires <= ?) "
+            "THEN excluded.expires ELSE state.expires END"
+        )
+        params = (key, amount, self._expires(ttl), now, bool(refresh_ttl), now)
+        conn = self._connection()
+        if self._returning:
+            value = conn.execute(upsert + " RETURNING value", params).fetchone()[0]
+        else:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute(upsert, params)
+                value = conn.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()[0]
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        self._maybe_purge(conn)
+        return int(value)
+
+    def update_json(self, key, update, ttl=None):
+        conn = self._connection()
+        # IMMEDIATE takes the write lock up front, so no other writer can slip in between the read and the write
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT value FROM state WHERE key = ? AND (expires IS NULL OR expires > ?)",
+                (key, time.time())
+            ).fetchone()
+            value = update(json.loads(row[0]) if row else None)
+            if value is not None:
+                conn.execute(
+                    "INSERT INTO state (key, value, expires) VALUES (?, ?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET value = excluded.value, expires = excluded.expires",
+                    (key, _as_bytes(json.dumps(value)), self._expires(ttl))
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return value
+
+    def expiry(self, key):
+        row = self._connection().execute(
+            "SELECT expires FROM state WHERE key = ? AND (expires IS NULL OR expires > ?)",
+            (key, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def reset(self, prefix=''):
+        escaped = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        cursor = self._connection().execute(
+            "DELETE FROM state WHERE key LIKE ? ESCAPE '\\'", (escaped + '%',)
+        )
+        return cursor.rowcount
+
+class RedisStateBackend(StateBackend):
+    """
+    State in Redis, or anything speaking the Redis protocol.
+
+    A minimal RESP client is enough for the handful of commands used here,
+    which keeps the redis package out of the dependencies.
+    """
+
+    def __init__(self, uri):
+        parsed = urlparse(uri)
+        self.host = parsed.hostname or '127.0.0.1'
+        self.port = parsed.port or 6379
+        self.password = unquote(parsed.password) if parsed.password else None
+        self.db = int(parsed.path.lstrip('/') or 0)
+        self.timeout = 5
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = (sock, sock.makefile('rb'))
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+            try:
+                if self.password:
+                    self._roundtrip([('AUTH', self.password)])
+                if self.db:
+                    self._roundtrip([('SELECT', self.db)])
+            except Exception:
+                # Never keep a connection that is not authenticated or on the right database
+                self._drop_connection()
+                raise
+        return conn
+
+    def _drop_connection(self):
+        conn = getattr(self._local, 'conn', None)
+        self._local.conn = None
+        if conn is not None:
+            try:
+                conn[0].close()
+            except OSError:
+                pass
+
+    @staticmethod
+    def _encode(command):
+        parts = [b'*%d\r\n' % len(command)]
+        for arg in command:
+            arg = _as_bytes(arg)
+            parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+        return b''.join(parts)
+
+    def _read_reply(self, reader):
+        """Read one reply; an error reply is returned as a StateBackendError, not raised."""
+        line = reader.readline()
+        if not line:
+            raise StateBackendError("Connection closed by state server")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b'+':
+            return payload.decode()
+        if kind == b'-':
+            return StateBackendError(payload.decode())
+        if kind == b':':
+            return int(payload)
+        if kind == b'$':
+            length = int(payload)
+            if length < 0:
+                return None
+            data = reader.read(length + 2)
+            return data[:-2]
+        if kind == b'*':
+            length = int(payload)
+            if length < 0:
+                return None
+            return [self._read_reply(reader) for _ in range(length)]
+        raise StateBackendError(f"Unexpected reply from state server: {line!r}")
+
+    def _roundtrip(self, commands):
+        """
+        Send a pipeline and read every reply before raising the first error one,
+        so no reply is left on the socket for the next caller to read. On any
+        other failure the connection is in an unknown state and is dropped.
+        """
+        sock, reader = self._local.conn
+        try:
+            sock.sendall(b''.join(self._encode(command) for command in commands))
+            replies = [self._read_reply(reader) for _ in commands]
+        except Exception:
+            self._drop_connection()
+            raise
+        for reply in replies:
+            for item in (reply if isinstance(reply, list) else [reply]):
+                if isinstance(item, StateBackendError):
+                    raise item
+        return replies
+
+    def execute(self, *commands):
+        """Send commands as one pipeline and return their replies; reconnects once on a dropped connection."""
+        for attempt in (1, 2):
+            self._connection()
+            try:
+                return self._roundtrip(commands)
+            except (OSError, StateBackendError) as e:
+                if isinstance(e, StateBackendError) and 'Connection closed' not in str(e):
+                    raise
+                self._drop_connection()
+                if attempt == 2:
+                    raise StateBackendError(f"State server unavailable: {e}") from e
+
+    def get(self, key):
+        return self.execute(('GET', key))[0]
+
+    def set(self, key, value, ttl=None):
+        command = ['SET', key, value]
+        if ttl:
+            command += ['PX', int(ttl * 1000)]
+        self.execute(command)
+
+    def add(self, key, value, ttl=None):
+        command = ['SET', key, value, 'NX']
+        if ttl:
+            command += ['PX', int(ttl * 1000)]
+        return self.execute(command)[0] == 'OK'
+
+    def delete(self, key):
+        self.execute(('DEL', key))
+
+    def incr(self, key, amount=1, ttl=None, refresh_ttl=False):
+        if not ttl:
+            return self.execute(('INCRBY', key, amount))[0]
+        ttl_ms = int(ttl * 1000)
+        # MULTI makes "create with expiry, then increment" a single atomic step
+        commands = [('MULTI',), ('SET', key, 0, 'PX', ttl_ms, 'NX'), ('INCRBY', key, amount)]
+        if refresh_ttl:
+            commands.append(('PEXPIRE', key, ttl_ms))
+        commands.append(('EXEC',))
+        replies = self.execute(*commands)
+        return int(replies[-1][1])
+
+    def update_json(self, key, update, ttl=None, attempts=20):
+        # Optimistic: EXEC is aborted (returns nil) if the key changed after WATCH
+        for _ in range(attempts):
+            current = self.execute(('WATCH', key), ('GET', key))[1]
+            value = update(json.loads(current) if current is not None else None)
+            if value is None:
+                self.execute(('UNWATCH',))
+                return None
+            command = ['SET', key, json.dumps(value)]
+            if ttl:
+                command += ['PX', int(ttl * 1000)]
+            if self.execute(('MULTI',), command, ('EXEC',))[-1] is not None:
+                return value
+        raise StateBackendError(f"Too much contention updating {key}")
+
+    def expiry(self, key):
+        ttl_ms = self.execute(('PTTL', key))[0]
+        if ttl_ms is None or ttl_ms < 0:
+            return None
+        return time.time() + ttl_ms / 1000
+
+    def reset(self, prefix=''):
+        keys = self.execute(('KEYS', prefix.replace('*', '\\*') + '*'))[0]
+        if not keys:
+            return 0
+        return self.execute(('DEL', *keys))[0]
+
+    def check(self):
+        try:
+            return self.execute(('PING',))[0] == 'PONG'
+        except Exception:
+            return False
+
+@lru_cache(maxsize=None)
+def create_state_backend(uri):
+    """
+    Return the process-wide backend for uri.
+
+    sqlite:///absolute/path.db, redis://[:password@]host:port/db
+    """
+    parsed = urlparse(uri)
+    if parsed.scheme == 'sqlite':
+        path = uri[len('sqlite://'):]
+        return SQLiteStateBackend(path)
+    if parsed.scheme == 'redis':
+        return RedisStateBackend(uri)
+    raise ValueError(f"Unsupported state backend URI: {uri}")
+
+def get_state_backend():
+    from flask import current_app
+    return create_state_backend(current_app.config['STATE_BACKEND_URI'])
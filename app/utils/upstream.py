@@ -0,0 +1,73 @@
+import json
+import time
+import requests
+
+CHUNK_SIZE = 64 * 1024
+
+# requests' timeout applies to each read, so a server trickling bytes could
+# otherwise hold a worker indefinitely; this bounds the whole response
+DEFAULT_DEADLINE = 30
+
+class UpstreamError(Exception):
+    pass
+
+class ResponseTooLarge(UpstreamError):
+    pass
+
+class UnexpectedContentType(UpstreamError):
+    pass
+
+class ResponseTooSlow(UpstreamError):
+    pass
+
+def content_type(response):
+    return response.headers.get('Content-Type', '').split(';')[0].strip().lower()
+
+def fetch_limited(url, max_bytes, content_types=None, rejected_types=None, deadline=DEFAULT_DEADLINE, **kwargs):
+    """
+    GET url and return (body, response), reading at most max_bytes within
+    deadline seconds.
+
+    The body is streamed, so an oversized response is abandoned as soon as it
+    passes the cap rather than after it has been buffered. Compressed bodies are
+    counted after decompression. content_types is a tuple of allowed type
+    prefixes such as ('application/json',), and rejected_types a tuple of
+    refused ones such as ('text/',); a response without a Content-Type is
+    allowed. The deadline is checked between reads, so it can be overrun by up
+    to one read timeout. Raises ResponseTooLarge, ResponseTooSlow or
+    UnexpectedContentType, all UpstreamErrors.
+    """
+    kwargs.setdefault('timeout', 10)
+    started = time.monotonic()
+    with requests.get(url, stream=True, **kwargs) as response:
+        response.raise_for_status()
+
+        mime_type = content_type(response)
+        if content_types and mime_type and not mime_type.startswith(tuple(content_types)):
+            raise UnexpectedContentType(f"{url} returned {mime_type}, expected {', '.join(content_types)}")
+        if rejected_types and mime_type.startswith(tuple(rejected_types)):
+            raise UnexpectedContentType(f"{url} returned {mime_type}")
+
+        declared = response.headers.get('Content-Length', '')
+        if declared.isdigit() and int(declared) > max_bytes:
+            raise ResponseTooLarge(f"{url} is {int(declared)} bytes, limit is {max_bytes}")
+
+        chunks = []
+        received = 0
+        for chunk in response.iter_content(CHUNK_SIZE):
+            if time.monotonic() - started > deadline:
+                raise ResponseTooSlow(f"{url} took longer than {deadline} seconds")
+            received += len(chunk)
+            if received > max_bytes:
+                raise ResponseTooLarge(f"{url} exceeded the {max_bytes} byte limit")
+            chunks.append(chunk)
+        return b''.join(chunks), response
+
+def fetch_limited_text(url, max_bytes, content_types=None, **kwargs):
+    """Like fetch_limited, returning the body decoded with the response's charset."""
+    body, response = fetch_limited(url, max_bytes, content_types, **kwargs)
+    return str(body, response.encoding or 'utf-8', errors='replace'), response
+
+def fetch_limited_json(url, max_bytes, **kwargs):
+    body, _ = fetch_limited(url, max_bytes, ('application/json',), **kwargs)
+    return json.loads(body)
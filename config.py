@@ -16,6 +16,49 @@ class Config:
     # Static files directory
     STATIC_DIR = os.path.abspath(os.path.join("app", "static"))
     
+    # Import WeasyPrint/PIL and load fonts at startup: in the gunicorn master before
+    # forking sync/gthread workers, or in each green worker once it has monkey-patched
+    PRELOAD_DOCUMENT_STACK = True
+
+    # State shared by all workers: rate limits, the job registry and caches.
+    # sqlite:///path suits a single host; use redis://host:port/db across hosts
+    STATE_BACKEND_URI = os.environ.get('STATE_BACKEND_URI', f"sqlite:///{os.path.abspath('state/state.db')}")
+    RATELIMIT_STORAGE_URI = f"state+{STATE_BACKEND_URI}"
+
+    # Seconds a fetched article is reused by later jobs for the same user
+    ARTICLE_CACHE_TTL = 600
+
+    # Limits on what is read from upstream. Responses are streamed and dropped
+    # once they pass the cap; images are also rejected if they decode to more
+    # than IMAGE_MAX_PIXELS pixels
+    JSON_MAX_BYTES = 5 * 1024 * 1024
+    ARTICLE_MAX_BYTES = 5 * 1024 * 1024
+    IMAGE_MAX_BYTES = 10 * 1024 * 1024
+    IMAGE_MAX_PIXELS = 40_000_000
+
+    # Ghostscript processes used to rasterise one CBZ; up to GENERATION_SLOTS
+    # jobs may be rasterising at once
+    CBZ_RASTER_WORKERS = 2
+
+    # Admission control for document generation, fair across Readeck users.
+    # Slots are shared by every worker using STATE_BACKEND_URI; jobs costing at
+    # most SMALL_JOB_COST (a couple of short articles) may also use the express slots.
+    # Keep ADMISSION_TIMEOUT well under the gunicorn worker timeout. A worker
+    # killed mid-render never releases its slot, so GENERATION_LEASE (seconds a
+    # running job holds its slot) is the worker timeout plus a small margin.
+    GENERATION_SLOTS = int(os.environ.get('GENERATION_SLOTS', os.cpu_count() or 2))
+    GENERATION_EXPRESS_SLOTS = 1
+    SMALL_JOB_COST = 5
+    MAX_JOBS_PER_USER = 1
+    ADMISSION_TIMEOUT = 60
+    GENERATION_LEASE = 180
+
+    # Opt-in per-request profiling of /generate_document. Requests must send the
+    # admin token in X-Admin-Token plus either X-Profile: 1 or "profile": true
+    PROFILING_ENABLED = os.environ.get('PROFILING_ENABLED') == '1'
+    PROFILING_ADMIN_TOKEN = os.environ.get('PROFILING_ADMIN_TOKEN')
+    PROFILE_DIR = os.path.abspath("profiles")
+
     # Other configurations...
     DEBUG = False
     TESTING = False
@@ -38,6 +81,10 @@ class ProductionConfig(Config):
 class TestingConfig(Config):
     TESTING = True
 
+class LoadTestConfig(ProductionConfig):
+    # Every simulated user shares one IP, so per-IP limits would throttle the run
+    RATELIMIT_ENABLED = False
+
 # You can add more configuration classes as needed
 
 # Set the active configuration
@@ -45,6 +92,7 @@ config = {
     'development': DevelopmentConfig,
     'production': ProductionConfig,
     'testing': TestingConfig,
+    'loadtest': LoadTestConfig,
     'default': DevelopmentConfig
 }
 
@@ -1,4 +1,7 @@
 import multiprocessing
+import os
+import shlex
+import sys
 
 wsgi_app = "wsgi:app"
 workers = multiprocessing.cpu_count() * 2 + 1
@@ -10,3 +13,45 @@ capture_output = True
 pidfile = "/var/run/gunicorn/devel.pid"
 daemon = False
 timeout = 150
+
+def requested_worker_class():
+    """The worker class given on the command line or in GUNICORN_CMD_ARGS, if any."""
+    args = shlex.split(os.environ.get('GUNICORN_CMD_ARGS', '')) + sys.argv[1:]
+    worker_class = None
+    for index, arg in enumerate(args):
+        if arg in ('-k', '--worker-class') and index + 1 < len(args):
+            worker_class = args[index + 1]
+        elif arg.startswith('--worker-class='):
+            worker_class = arg.split('=', 1)[1]
+        elif arg.startswith('-k') and len(arg) > 2:
+            worker_class = arg[2:]
+    return worker_class or ''
+
+GREEN_WORKER_CLASSES = ('eventlet', 'gevent')
+
+# Load the app, document stack and static assets once in the master so that
+# forked workers share them copy-on-write instead of each paying the cost.
+#
+# Green workers (start-server.sh uses eventlet) monkey-patch in the worker after
+# the fork, and patching after flask, requests and socketio have been imported
+# leaves their locks and sockets the unpatched kind (eventlet reports this on
+# every boot). Those workers therefore load the app themselves and warm the
+# document stack up once patched; only sync and gthread workers preload.
+preload_app = not any(green in requested_worker_class() for green in GREEN_WORKER_CLASSES)
+
+def when_ready(server):
+    if not preload_app:
+        return
+    from app.utils.startup import warm_up, freeze_for_fork, log_report
+    app = server.app.wsgi()
+    if app.config.get('PRELOAD_DOCUMENT_STACK'):
+        log_report(warm_up(app))
+        freeze_for_fork()
+
+def post_worker_init(worker):
+    if preload_app:
+        return
+    from app.utils.startup import warm_up, log_report
+    app = worker.wsgi
+    if app.config.get('PRELOAD_DOCUMENT_STACK'):
+        log_report(warm_up(app))
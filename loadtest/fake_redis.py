@@ -0,0 +1,219 @@
+"""
+Local stand-in for a Redis server, for exercising RedisStateBackend without Redis.
+
+Implements only the commands the state backend sends (plus PING/AUTH/SELECT),
+with key expiry, WATCH and MULTI/EXEC transactions executed under one lock.
+
+    python -m loadtest.fake_redis --port 6390
+"""
+import argparse
+import fnmatch
+import logging
+import socketserver
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+class CommandError(Exception):
+    pass
+
+class FakeRedisStore:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.data = {}
+        # Bumped on every write, for WATCH
+        self.versions = {}
+
+    def _touch(self, key):
+        self.versions[key] = self.versions.get(key, 0) + 1
+
+    def _live(self, key):
+        entry = self.data.get(key)
+        if entry and entry[1] is not None and entry[1] <= time.time():
+            del self.data[key]
+            return None
+        return entry
+
+    def execute(self, name, args):
+        handler = getattr(self, f'cmd_{name.lower()}', None)
+        if handler is None:
+            raise CommandError(f"ERR unknown command '{name}'")
+        with self.lock:
+            return handler(*args)
+
+    def cmd_ping(self, *args):
+        return 'PONG'
+
+    def cmd_auth(self, *args):
+        return 'OK'
+
+    def cmd_select(self, *args):
+        return 'OK'
+
+    def cmd_get(self, key):
+        entry = self._live(key)
+        return entry[0] if entry else None
+
+    def cmd_set(self, key, value, *options):
+        options = [option.decode().upper() if isinstance(option, bytes) else option for option in options]
+        expires = None
+        if 'PX' in options:
+            expires = time.time() + int(options[options.index('PX') + 1]) / 1000
+        if 'EX' in options:
+            expires = time.time() + int(options[options.index('EX') + 1])
+        if 'NX' in options and self._live(key):
+            return None
+        self.data[key] = [value, expires]
+        self._touch(key)
+        return 'OK'
+
+    def cmd_del(self, *keys):
+        deleted = 0
+        for key in keys:
+            if self._live(key) and self.data.pop(key, None) is not None:
+                self._touch(key)
+                deleted += 1
+        return deleted
+
+    def cmd_incrby(self, key, amount):
+        entry = self._live(key)
+        try:
+            value = int(entry[0]) + int(amount) if entry else int(amount)
+        except ValueError:
+            raise CommandError('ERR value is not an integer or out of range')
+        self.data[key] = [str(value).encode(), entry[1] if entry else None]
+        self._touch(key)
+        return value
+
+    def cmd_incr(self, key):
+        return self.cmd_incrby(key, 1)
+
+    def cmd_pexpire(self, key, milliseconds):
+        entry = self._live(key)
+        if not entry:
+            return 0
+        entry[1] = time.time() + int(milliseconds) / 1000
+        self._touch(key)
+        return 1
+
+    def cmd_pttl(self, key):
+        entry = self._live(key)
+        if not entry:
+            return -2
+        if entry[1] is None:
+            return -1
+        return int((entry[1] - time.time()) * 1000)
+
+    def cmd_keys(self, pattern):
+        pattern = pattern.decode()
+        return [key for key in list(self.data) if self._live(key) and fnmatch.fnmatchcase(key.decode(), pattern)]
+
+def encode_reply(reply):
+    if isinstance(reply, CommandError):
+        return b'-%s\r\n' % str(reply).encode()
+    if reply is None:
+        return b'$-1\r\n'
+    if isinstance(reply, str):
+        return b'+%s\r\n' % reply.encode()
+    if isinstance(reply, int):
+        return b':%d\r\n' % reply
+    if isinstance(reply, bytes):
+        return b'$%d\r\n%s\r\n' % (len(reply), reply)
+    if isinstance(reply, list):
+        return b'*%d\r\n' % len(reply) + b''.join(encode_reply(item) for item in reply)
+    raise TypeError(f"Cannot encode {reply!r}")
+
+def read_command(reader):
+    line = reader.readline()
+    if not line:
+        return None
+    if not line.startswith(b'*'):
+        return line.split()
+    args = []
+    for _ in range(int(line[1:])):
+        length = int(reader.readline()[1:])
+        args.append(reader.read(length + 2)[:-2])
+    return args
+
+class FakeRedisHandler(socketserver.StreamRequestHandler):
+    # Pipelined replies are written one by one; Nagle would hold them back
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        store = self.server.store
+        transaction = None
+        watched = {}
+        while True:
+            command = read_command(self.rfile)
+            if not command:
+                return
+            name, args = command[0].decode().upper(), command[1:]
+
+            if name == 'WATCH':
+                with store.lock:
+                    watched.update((key, store.versions.get(key, 0)) for key in args)
+                reply = 'OK'
+            elif name == 'UNWATCH':
+                watched = {}
+                reply = 'OK'
+            elif name == 'MULTI':
+                transaction = []
+                reply = 'OK'
+            elif name == 'EXEC':
+                if transaction is None:
+                    reply = CommandError('ERR EXEC without MULTI')
+                else:
+                    with store.lock:
+                        if any(store.versions.get(key, 0) != version for key, version in watched.items()):
+                            reply = None
+                        else:
+                            reply = []
+                            for queued_name, queued_args in transaction:
+                                try:
+                                    reply.append(store.execute(queued_name, queued_args))
+                                except CommandError as e:
+                                    reply.append(e)
+                    transaction = None
+                    watched = {}
+            elif transaction is not None:
+                transaction.append((name, args))
+                reply = 'QUEUED'
+            else:
+                try:
+                    reply = store.execute(name, args)
+                except CommandError as e:
+                    reply = e
+            self.wfile.write(encode_reply(reply))
+
+class FakeRedisServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=0):
+        super().__init__((host, port), FakeRedisHandler)
+        self.store = FakeRedisStore()
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'redis://{host}:{port}/0'
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Redis-protocol stand-in for the state backend')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6390)
+    args = parser.parse_args()
+    server = FakeRedisServer(args.host, args.port)
+    print(f'Listening on {server.url}')
+    server.serve_forever()
@@ -0,0 +1,140 @@
+"""
+Local stand-in for a Readeck instance and the image hosts its articles link to.
+
+Serves just enough of the Readeck API for /fetch_articles and /generate_document:
+the bookmark list, bookmark details and article HTML, plus generated JPEGs.
+"""
+import io
+import json
+import logging
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_UPSTREAM = {
+    'articles': 50,
+    'paragraphs': 30,
+    'images_per_article': 3,
+    'shared_images': 1,
+    'image_width': 1600,
+    'image_height': 1000,
+    'latency_ms': 20,
+}
+
+LOREM = ("E-ink readers reward long-form writing with calm, paper-like pages. "
+         "This paragraph stands in for the body text of a saved article, "
+         "long enough to wrap several times and exercise justification. ")
+
+def generate_jpeg(width, height, seed):
+    from PIL import Image, ImageDraw
+    rng = random.Random(seed)
+    image = Image.new('RGB', (width, height), tuple(rng.randrange(256) for _ in range(3)))
+    draw = ImageDraw.Draw(image)
+    for _ in range(40):
+        x, y = rng.randrange(width), rng.randrange(height)
+        draw.rectangle([x, y, x + rng.randrange(width // 4), y + rng.randrange(height // 4)],
+                       fill=tuple(rng.randrange(256) for _ in range(3)))
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=90)
+    return buffer.getvalue()
+
+class FakeUpstream:
+    def __init__(self, host='127.0.0.1', port=0, **options):
+        self.options = dict(DEFAULT_UPSTREAM, **options)
+        self._images = {}
+        self._images_lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        logger.info(f"Fake Readeck listening on {self.url}")
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def image(self, name):
+        with self._images_lock:
+            if name not in self._images:
+                self._images[name] = generate_jpeg(self.options['image_width'], self.options['image_height'], name)
+            return self._images[name]
+
+    def bookmark(self, article_id):
+        return {
+            'id': article_id,
+            'title': f'Load test article {article_id}',
+            'url': f'https://example.com/articles/{article_id}',
+            'authors': ['Load Tester'],
+            'author': 'Load Tester',
+            'created': '2024-01-01T00:00:00Z',
+            'created_at': '2024-01-01T00:00:00Z',
+            'labels': ['loadtest'],
+            'content': '',
+            'resources': {'article': {'src': f'{self.url}/api/bookmarks/{article_id}/article'}},
+        }
+
+    def article_html(self, article_id):
+        paragraphs = [f'<p>{LOREM * 3}</p>' for _ in range(self.options['paragraphs'])]
+        images = []
+        for index in range(self.options['images_per_article']):
+            # The first few images are shared by every article, like logos and avatars
+            name = f'shared-{index}' if index < self.options['shared_images'] else f'{article_id}-{index}'
+            images.append(f'<figure><img src="{self.url}/images/{name}.jpg"><figcaption>Figure {index}</figcaption></figure>')
+        step = max(1, len(paragraphs) // (len(images) + 1))
+        for offset, image in enumerate(images, start=1):
+            paragraphs.insert(min(offset * step + offset - 1, len(paragraphs)), image)
+        return f'<article><h2>Article {article_id}</h2>{"".join(paragraphs)}</article>'
+
+    def _handler_class(self):
+        upstream = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+            def send_body(self, body, content_type, status=200):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                time.sleep(upstream.options['latency_ms'] / 1000)
+                parsed = urlparse(self.path)
+                path = parsed.path.rstrip('/')
+
+                if path == '/api/bookmarks':
+                    query = parse_qs(parsed.query)
+                    offset = int(query.get('offset', ['0'])[0])
+                    limit = int(query.get('limit', ['50'])[0])
+                    ids = [f'article{n}' for n in range(offset, min(offset + limit, upstream.options['articles']))]
+                    return self.send_body(json.dumps([{'id': i} for i in ids]).encode(), 'application/json')
+
+                match = re.fullmatch(r'/api/bookmarks/([\w-]+)(/article)?', path)
+                if match:
+                    if match.group(2):
+                        return self.send_body(upstream.article_html(match.group(1)).encode(), 'text/html; charset=utf-8')
+                    return self.send_body(json.dumps(upstream.bookmark(match.group(1))).encode(), 'application/json')
+
+                match = re.fullmatch(r'/images/([\w-]+)\.jpg', path)
+                if match:
+                    return self.send_body(upstream.image(match.group(1)), 'image/jpeg')
+
+                self.send_body(b'Not found', 'text/plain', status=404)
+
+        return Handler
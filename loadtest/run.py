@@ -0,0 +1,358 @@
+"""
+Concurrent-user load test for the Flask + Socket.IO service.
+
+Starts a fake Readeck/image server, optionally launches the real app under
+gunicorn with the eventlet worker (as start-server.sh does), then simulates
+users running the scenario's flows and reports throughput, latency
+percentiles, error rates and server RSS over time.
+
+    python -m loadtest.run loadtest/scenarios/picker.json --launch
+    python -m loadtest.run loadtest/scenarios/mixed.json --target http://127.0.0.1:5001 --server-pid 1234
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import re
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+import requests
+
+from loadtest.fake_upstream import FakeUpstream
+
+logger = logging.getLogger('loadtest')
+
+CSRF_META_RE = re.compile(r'<meta name="csrf-token" content="([^"]+)"')
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(lambda: defaultdict(int))
+        self.progress_events = 0
+        self.rss_samples = []
+
+    def record(self, name, seconds, error=None):
+        with self.lock:
+            self.latencies[name].append(seconds)
+            if error:
+                self.errors[name][error] += 1
+
+    def record_progress(self):
+        with self.lock:
+            self.progress_events += 1
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+def descendant_pids(pid):
+    children = defaultdict(list)
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as stat:
+                parent = int(stat.read().rsplit(')', 1)[1].split()[1])
+            children[parent].append(int(entry))
+        except (OSError, IndexError, ValueError):
+            continue
+    pids, stack = [], [pid]
+    while stack:
+        current = stack.pop()
+        pids.append(current)
+        stack.extend(children.get(current, []))
+    return pids
+
+def rss_bytes(pid):
+    """Resident set size of pid and all its descendants (gunicorn master, workers, gs)."""
+    total = 0
+    for process in descendant_pids(pid):
+        try:
+            with open(f'/proc/{process}/status') as status:
+                for line in status:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+                        break
+        except OSError:
+            continue
+    return total
+
+def sample_rss(pid, stats, stop, interval):
+    start = time.monotonic()
+    while not stop.is_set():
+        rss = rss_bytes(pid)
+        with stats.lock:
+            stats.rss_samples.append((time.monotonic() - start, rss))
+        stop.wait(interval)
+
+class User:
+    def __init__(self, user_id, target, upstream_url, stats, scenario):
+        self.user_id = user_id
+        self.target = target.rstrip('/')
+        self.upstream_url = upstream_url
+        self.stats = stats
+        self.scenario = scenario
+        self.session = requests.Session()
+        self.csrf_token = None
+        self.socket = None
+        self.rng = random.Random(user_id)
+
+    def timed(self, name, method, path, **kwargs):
+        start = time.perf_counter()
+        error = None
+        response = None
+        try:
+            response = self.session.request(method, f'{self.target}{path}',
+                                            timeout=self.scenario.get('request_timeout', 300), **kwargs)
+            if response.status_code >= 400:
+                error = str(response.status_code)
+        except requests.RequestException as e:
+            error = type(e).__name__
+        self.stats.record(name, time.perf_counter() - start, error)
+        return response if error is None else None
+
+    def load_index(self):
+        response = self.timed('GET /', 'GET', '/')
+        if response is not None:
+            match = CSRF_META_RE.search(response.text)
+            self.csrf_token = match.group(1) if match else None
+
+    def connect_socket(self):
+        import socketio
+        self.socket = socketio.Client(reconnection=False, http_session=self.session)
+        self.socket.on('document_progress', lambda data: self.stats.record_progress())
+        start = time.perf_counter()
+        try:
+            self.socket.connect(self.target, auth={'csrf_token': self.csrf_token}, wait_timeout=10)
+            self.stats.record('socket.io connect', time.perf_counter() - start)
+        except Exception as e:
+            self.stats.record('socket.io connect', time.perf_counter() - start, type(e).__name__)
+            self.socket = None
+
+    def post_json(self, name, path, payload):
+        return self.timed(name, 'POST', path, json=payload, headers={'X-CSRFToken': self.csrf_token or ''})
+
+    def fetch_articles(self):
+        response = self.post_json('POST /fetch_articles', '/fetch_articles', {
+            'api_key': f'loadtest-{self.user_id}',
+            'readeck_url': self.upstream_url,
+            'page_type': 'article_selection',
+            'emit_progress': False,
+        })
+        if response is None:
+            return []
+        try:
+            return [article['id'] for article in response.json().get('articles', [])]
+        except ValueError:
+            return []
+
+    def picker_flow(self, flow):
+        self.load_index()
+        self.timed('GET /settings', 'GET', '/settings')
+        self.fetch_articles()
+
+    def generate_flow(self, flow):
+        self.load_index()
+        if flow.get('socketio', True):
+            self.connect_socket()
+        try:
+            article_ids = self.fetch_articles()
+            if not article_ids:
+                return
+            count = min(flow.get('articles', 5), len(article_ids))
+            payload = {
+                'api_key': f'loadtest-{self.user_id}',
+                'readeck_url': self.upstream_url,
+                'article_ids': self.rng.sample(article_ids, count),
+                'output_format': flow.get('output_format', 'pdf'),
+                'two_column_layout': flow.get('two_column_layout', False),
+            }
+            for key in ('output_formats', 'device_profile', 'device_profiles', 'dither'):
+                if key in flow:
+                    payload[key] = flow[key]
+            self.post_json(f"POST /generate_document ({flow['name']})", '/generate_document', payload)
+        finally:
+            if self.socket:
+                self.socket.disconnect()
+                self.socket = None
+
+    def run(self, deadline, iterations):
+        flows = self.scenario['flows']
+        weights = [flow.get('weight', 1) for flow in flows]
+        completed = 0
+        while time.monotonic() < deadline and (iterations is None or completed < iterations):
+            flow = self.rng.choices(flows, weights)[0]
+            start = time.perf_counter()
+            error = None
+            try:
+                getattr(self, f"{flow['type']}_flow")(flow)
+            except Exception as e:
+                logger.exception(f"User {self.user_id} flow {flow['name']} crashed")
+                error = type(e).__name__
+            self.stats.record(f"flow {flow['name']}", time.perf_counter() - start, error)
+            completed += 1
+            think = self.scenario.get('think_time', 0)
+            if think:
+                time.sleep(self.rng.uniform(0, 2 * think))
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def launch_server(port, workers):
+    """Run the real app the way start-server.sh does, with rate limits disabled."""
+    pidfile = os.path.join(tempfile.gettempdir(), f'loadtest-gunicorn-{port}.pid')
+    env = dict(os.environ, FLASK_ENV='loadtest')
+    process = subprocess.Popen([
+        sys.executable, '-m', 'gunicorn', '--worker-class', 'eventlet', '-w', str(workers),
+        '--config', 'gunicorn.conf.py', '--bind', f'127.0.0.1:{port}', '--pid', pidfile,
+        'loadtest.wsgi:app',
+    ], env=env)
+    target = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'Server exited with code {process.returncode}')
+        try:
+            requests.get(target, timeout=1)
+            return process, target
+        except requests.RequestException:
+            time.sleep(0.5)
+    process.terminate()
+    raise RuntimeError('Server did not start within 60 seconds')
+
+def format_bytes(count):
+    return f'{count / (1024 * 1024):.1f} MiB'
+
+def build_report(scenario, stats, elapsed):
+    rows = []
+    for name in sorted(stats.latencies):
+        values = stats.latencies[name]
+        errors = sum(stats.errors[name].values())
+        rows.append({
+            'name': name,
+            'count': len(values),
+            'throughput_per_s': len(values) / elapsed if elapsed else 0,
+            'p50_ms': percentile(values, 0.50) * 1000,
+            'p95_ms': percentile(values, 0.95) * 1000,
+            'p99_ms': percentile(values, 0.99) * 1000,
+            'error_rate': errors / len(values) if values else 0,
+            'errors': dict(stats.errors[name]),
+        })
+    return {
+        'scenario': scenario['name'],
+        'users': scenario['users'],
+        'elapsed_s': elapsed,
+        'requests': rows,
+        'progress_events': stats.progress_events,
+        'rss': [{'t_s': t, 'bytes': rss} for t, rss in stats.rss_samples],
+    }
+
+def print_report(report):
+    print(f"\nScenario {report['scenario']}: {report['users']} users, {report['elapsed_s']:.1f}s")
+    header = f"{'request':48} {'count':>6} {'req/s':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>7}"
+    print(header)
+    print('-' * len(header))
+    for row in report['requests']:
+        print(f"{row['name'][:48]:48} {row['count']:6d} {row['throughput_per_s']:7.2f} "
+              f"{row['p50_ms']:9.1f} {row['p95_ms']:9.1f} {row['p99_ms']:9.1f} {row['error_rate']:7.1%}")
+        for error, count in row['errors'].items():
+            print(f"    {error}: {count}")
+    print(f"\nsocket.io progress events received: {report['progress_events']}")
+
+    if report['rss']:
+        peak = max(sample['bytes'] for sample in report['rss'])
+        print(f"Server RSS: start {format_bytes(report['rss'][0]['bytes'])}, "
+              f"peak {format_bytes(peak)}, end {format_bytes(report['rss'][-1]['bytes'])}")
+        step = max(1, len(report['rss']) // 20)
+        for sample in report['rss'][::step]:
+            print(f"  {sample['t_s']:7.1f}s  {format_bytes(sample['bytes'])}")
+
+def run_scenario(scenario, target, upstream, server_pid=None, rss_interval=1.0):
+    stats = Stats()
+    stop = threading.Event()
+    sampler = None
+    if server_pid:
+        sampler = threading.Thread(target=sample_rss, args=(server_pid, stats, stop, rss_interval), daemon=True)
+        sampler.start()
+
+    users = scenario['users']
+    ramp_up = scenario.get('ramp_up', 0)
+    iterations = scenario.get('iterations')
+    start = time.monotonic()
+    deadline = start + scenario.get('duration', 60) + ramp_up
+
+    threads = []
+    for user_id in range(users):
+        user = User(user_id, target, upstream.url, stats, scenario)
+        thread = threading.Thread(target=user.run, args=(deadline, iterations), daemon=True)
+        threads.append(thread)
+        thread.start()
+        if ramp_up:
+            time.sleep(ramp_up / users)
+    for thread in threads:
+        thread.join()
+
+    elapsed = time.monotonic() - start
+    stop.set()
+    if sampler:
+        sampler.join()
+    return build_report(scenario, stats, elapsed)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('scenario', help='Path to a scenario JSON file')
+    parser.add_argument('--target', help='Base URL of an already running server')
+    parser.add_argument('--launch', action='store_true', help='Start the app under gunicorn/eventlet for the run')
+    parser.add_argument('--workers', type=int, default=1, help='gunicorn workers when using --launch')
+    parser.add_argument('--server-pid', type=int, help='PID of the running server, for RSS sampling')
+    parser.add_argument('--users', type=int, help='Override the scenario user count')
+    parser.add_argument('--duration', type=float, help='Override the scenario duration in seconds')
+    parser.add_argument('--json', help='Also write the report to this file')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    with open(args.scenario) as scenario_file:
+        scenario = json.load(scenario_file)
+    if args.users:
+        scenario['users'] = args.users
+    if args.duration:
+        scenario['duration'] = args.duration
+
+    if not args.target and not args.launch:
+        parser.error('either --target or --launch is required')
+
+    upstream = FakeUpstream(**scenario.get('upstream', {})).start()
+    server = None
+    try:
+        target, server_pid = args.target, args.server_pid
+        if args.launch:
+            server, target = launch_server(free_port(), args.workers)
+            server_pid = server.pid
+        report = run_scenario(scenario, target, upstream, server_pid)
+    finally:
+        if server:
+            server.send_signal(signal.SIGTERM)
+            server.wait(timeout=30)
+        upstream.stop()
+
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+
+if __name__ == '__main__':
+    main()
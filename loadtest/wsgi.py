@@ -0,0 +1,5 @@
+from app import create_app
+from config import get_config
+
+# Entry point used by loadtest.run --launch; FLASK_ENV=loadtest selects LoadTestConfig
+app = create_app(get_config())